@@ -7,7 +7,7 @@ import os
 
 from datetime import datetime
 
-from ripetor import data, statistics, measurements, atlas
+from ripetor import data, statistics, measurements, atlas, journal
 from ripetor.util.common import set_global_file_logger
 
 
@@ -17,12 +17,19 @@ def download(base_path):
     os.makedirs(data_path)
 
     # summary = ripetor_data.load_summary(data_path + "summary.json")
-    details = data.load_details(data_path + "details.json")
-    probes = data.load_probes(data_path + "probes.json")
-    data.download_ip2asn_v4(data_path + "ip2asn-v4.tsv")
-    data.download_ip2asn_v6(data_path + "ip2asn-v6.tsv")
-
-    logging.info("Finished downloading")
+    # all four come from different hosts, fetch them at the same time
+    start = time.monotonic()
+    data.download_concurrently({
+        data_path + "details.json": data.download_details,
+        data_path + "probes.json": data.download_probes,
+        data_path + "ip2asn-v4.tsv": data.download_ip2asn_v4,
+        data_path + "ip2asn-v6.tsv": data.download_ip2asn_v6,
+    })
+    logging.info("Finished downloading after %.1f seconds" % (time.monotonic() - start))
+
+    # only keep the fields we need instead of the full documents
+    details = data.load_details(data_path + "details.json", data.RELAY_FIELDS)
+    probes = data.load_probes(data_path + "probes.json", data.PROBE_FIELDS)
 
     return details, probes
 
@@ -42,12 +49,8 @@ def print_statistics(details, probes):
 def create_sets_f(details, probes, c_as, d_as, base_path, ip_version="ipv4"):
     logging.info("Start creating sets")
 
-    g_as = measurements.create_guard_set(details, ip_version)
-    e_as = measurements.create_exit_set(details, ip_version)
-    g_as_r = measurements.create_guard_with_ripe_probes_set(details, probes, ip_version)
-    e_as_r = measurements.create_exit_with_ripe_probes_set(details, probes, ip_version)
-
-    sets = {"g_as": g_as, "e_as": e_as, "g_as_r": g_as_r, "e_as_r": e_as_r, "c_as": c_as, "d_as": d_as}
+    # one pass over relays and probes builds the sets of both address families
+    sets = dict(measurements.create_all_sets(details, probes)[ip_version], c_as=c_as, d_as=d_as)
 
     set_path = base_path + "/measurement-sets/"
     os.makedirs(set_path)
@@ -62,7 +65,7 @@ def create_sets_f(details, probes, c_as, d_as, base_path, ip_version="ipv4"):
     return sets
 
 
-def create_measurement_definitions(measurement_sets, now_string, base_path, ip_version="ipv4"):
+def create_measurement_definitions(measurement_sets, now_string, base_path, ip_version="ipv4", credit_budget=None):
     logging.info("Start creating RIPE measurements")
 
     definitions_path = base_path + "/measurement-definitions/"
@@ -71,79 +74,107 @@ def create_measurement_definitions(measurement_sets, now_string, base_path, ip_v
     logging.info("Total theoretical cost c1: %d c2: %d c3: %d c4: %d total: %d" %
                  measurements.calculate_costs_for_measurement_set(measurement_sets))
 
-    measurement_definitions = dict()
-    if measurement_sets["c_as"]:
-        measurement_definitions["case1"] = measurements.create_case1(now_string,
-                                                                     measurement_sets["c_as"],
-                                                                     measurement_sets["g_as"],
-                                                                     ip_version)
-
-        measurement_definitions["case4"] = measurements.create_case4(now_string,
-                                                                     measurement_sets["g_as_r"],
-                                                                     measurement_sets["c_as"],
-                                                                     ip_version)
-
-    if measurement_sets["d_as"]:
-        measurement_definitions["case2"] = measurements.create_case2(now_string,
-                                                                     measurement_sets["e_as_r"],
-                                                                     measurement_sets["d_as"],
-                                                                     ip_version)
-
-        measurement_definitions["case3"] = measurements.create_case3(now_string,
-                                                                     measurement_sets["d_as"],
-                                                                     measurement_sets["e_as"],
-                                                                     ip_version)
-
-    for case_description, definition_list in measurement_definitions.items():
-        for idx, single_measurement in enumerate(definition_list):
-            logging.debug("Created measurement definition for %s part %d" % (case_description, idx))
-            with open(definitions_path + "%s_%d.json" % (case_description, idx), "w") as f:
-                json.dump(single_measurement, f, indent=2)
+    # pack the definitions of all cases into the concurrency window of RIPE Atlas
+    plan = measurements.plan_measurements(now_string, measurement_sets, atlas.MAX_MEASUREMENTS, ip_version,
+                                          credit_budget)
+    logging.info("Planned %d requests costing %d credits, predicted to finish after %d seconds" %
+                 (len(plan["measurements"]), plan["cost"], plan["completion"]))
+
+    for planned in plan["measurements"]:
+        logging.debug("Created measurement definition for %s part %d" % (planned["case"], planned["part"]))
+        with open(definitions_path + "%s_%d.json" % (planned["case"], planned["part"]), "w") as f:
+            json.dump(planned["definition"], f, indent=2)
+
+    with open(definitions_path + "plan.json", "w") as f:
+        json.dump({"cost": plan["cost"], "completion": plan["completion"], "skipped": plan["skipped"],
+                   "measurements": [{k: v for k, v in planned.items() if k != "definition"}
+                                    for planned in plan["measurements"]]}, f, indent=2)
 
     logging.info("Stop creating RIPE measurements")
-    return measurement_definitions
+    return plan["measurements"]
 
 
-def start_executing_measurements(measurement_definitions, base_path):
+def start_executing_measurements(planned_measurements, base_path, scheduler=None):
     logging.info("Start executing RIPE measurements")
 
     response_path = base_path + "/measurement-responses/"
-    os.makedirs(response_path)
+    os.makedirs(response_path, exist_ok=True)
 
     result_path = base_path + "/measurement-results/"
     os.makedirs(result_path, exist_ok=True)
 
-    # MM: this response dict stores all measurement IDs with the corresponding progress
-    # if in caseX, the measurement is still ongoing, if in downloaded or finished, the measurement is done
-    measurement_responses = {"downloaded": [], "finished": [], "case1": [], "case2": [], "case3": [], "case4": []}
-
-    # MM: iterate over all cases and definitions
-    for case_description, definition_list in measurement_definitions.items():
-        for idx, single_measurement in enumerate(definition_list):
-            # Determine how many new measurements we would be starting with this definition
-            number_measurements = measurements.calculate_number_of_measurements(single_measurement)
-
-            # MM: if the currently running plus the new measurements would be above 100
-            # wait for 40 seconds and attempt to download all running measurements.
-            # Further, if the measurements did not stop after 40 seconds, we stop them
-            atlas.wait_and_download(
-                result_path,
-                measurement_responses,
-                nr_measurement=number_measurements
-            )
-
-            # MM: Start the new measurement(s), at this point, no measurements should be running!
-            response = atlas.start_definition(single_measurement)
-            time.sleep(15)
-
-            # MM: Dump the gotten response for the started measurements and add the measurement IDs to our case set
-            logging.debug("Response for %s part %d: %s" % (case_description, idx, response))
-            with open(response_path + "%s_%d_response.json" % (case_description, idx), "w") as f:
-                json.dump(response, f, indent=2)
-            measurement_responses[case_description].extend(response["measurements"])
+    if scheduler is None:
+        # MM: this response dict stores all measurement IDs with the corresponding progress
+        # if in caseX, the measurement is still ongoing, if in downloaded or finished, the measurement is done
+        measurement_responses = {"downloaded": [], "finished": [], "case1": [], "case2": [], "case3": [], "case4": []}
+
+        # the journal keeps track of every started measurement, so the run can be resumed (--resume)
+        campaign_journal = journal.CampaignJournal(journal.journal_filename(base_path))
+        scheduler = atlas.MeasurementScheduler(result_path, measurement_responses, journal=campaign_journal)
+
+    # MM: iterate over all planned definitions, in the order of the plan
+    # the scheduler polls every started measurement on its own schedule and frees slots as they finish
+    for nr_planned, planned in enumerate(planned_measurements):
+        case_description, idx, single_measurement = planned["case"], planned["part"], planned["definition"]
+
+        # Determine how many new measurements we would be starting with this definition
+        number_measurements = measurements.calculate_number_of_measurements(single_measurement)
+
+        # MM: if the currently running plus the new measurements would be above 100,
+        # download results and stop complete measurements until there is room
+        if not scheduler.wait_for_slots(number_measurements):
+            # rather stop than wait forever, the journal lets --resume start the rest later on
+            logging.error("No free slots for %s part %d after %d seconds, not starting the last %d requests" %
+                          (case_description, idx, atlas.SLOT_TIMEOUT_SECONDS, len(planned_measurements) - nr_planned))
+            break
+
+        # MM: Start the new measurement(s)
+        response = scheduler.start(case_description, single_measurement, idx)
+        if response is None:
+            logging.error("Could not start %s part %d" % (case_description, idx))
+            continue
+
+        # MM: Dump the gotten response for the started measurements
+        logging.debug("Response for %s part %d: %s" % (case_description, idx, response))
+        with open(response_path + "%s_%d_response.json" % (case_description, idx), "w") as f:
+            json.dump(response, f, indent=2)
 
     logging.info("Stop executing RIPE measurements")
-    return measurement_responses
+    return scheduler
+
+
+def resume_measurements(base_path):
+    """
+    Scheduler with the measurements of an interrupted run (from its journal) and the planned requests
+    that were not sent yet
+    """
+    logging.info("Resume RIPE measurements")
+
+    definitions_path = base_path + "/measurement-definitions/"
+    with open(definitions_path + "plan.json") as f:
+        plan = json.load(f)
+
+    campaign_journal = journal.CampaignJournal(journal.journal_filename(base_path))
+    started, unconfirmed, measurement_responses = campaign_journal.replay()
+    for case, idx in sorted(unconfirmed):
+        # the credits may have been spent already, rather miss it than run it twice
+        logging.warning("Unknown whether %s part %d was started before the interruption, skipping it" % (case, idx))
+
+    sent = started | unconfirmed
+    planned_measurements = []
+    for planned in plan["measurements"]:
+        if (planned["case"], planned["part"]) in sent:
+            continue
+        with open(definitions_path + "%s_%d.json" % (planned["case"], planned["part"])) as f:
+            planned_measurements.append(dict(planned, definition=json.load(f)))
+
+    logging.info("%d measurements running, %d waiting to be confirmed stopped, %d finished, %d requests to start" %
+                 (len(get_running_measurement(measurement_responses)), len(measurement_responses["downloaded"]),
+                  len(measurement_responses["finished"]), len(planned_measurements)))
+
+    result_path = base_path + "/measurement-results/"
+    scheduler = atlas.MeasurementScheduler(result_path, measurement_responses, journal=campaign_journal)
+    return scheduler, planned_measurements
 
 
 def get_running_measurement(measurement_responses: dict):
@@ -155,38 +186,26 @@ def get_running_measurement(measurement_responses: dict):
     return running
 
 
-def download_results(measurement_responses, base_path):
+def download_results(scheduler):
     logging.info("Start downloading results")
 
-    result_path = base_path + "/measurement-results/"
-    os.makedirs(result_path, exist_ok=True)
-
-    done = get_running_measurement(measurement_responses) == 0
-    running_counter = 0
-    while not done:
-        # Retry the download of everything
-        atlas.download_everything(result_path, measurement_responses)
-
-        running = get_running_measurement(measurement_responses)
-        if len(running) == 0:
-            done = True
-            logging.info(f'All cases finished downloading')
-        elif running_counter == 10:
-            done = True
-            logging.warning(f'Stopped prematurely after 10 minutes of retrying')
-            logging.warning(f'Still running {len(running)} cases: {" ".join(running)}')
-        else:
-            running_counter += 1
-            logging.info(f'Retrying download cycle after 60 seconds')
-            time.sleep(60)
+    # keep polling until every measurement finished, at most DRAIN_TIMEOUT_SECONDS after the last start
+    remaining = scheduler.drain(atlas.DRAIN_TIMEOUT_SECONDS)
+    if not remaining:
+        logging.info(f'All cases finished downloading')
+    else:
+        logging.warning(f'Stopped prematurely after {atlas.DRAIN_TIMEOUT_SECONDS} seconds of polling')
+        logging.warning(f'Still running {len(remaining)} measurements: {" ".join(map(str, remaining))}')
 
     logging.info("Finished downloading")
 
 
 def build_probe_set_for_asn(probes, asn_list, ip_version):
+    # group the probes once instead of once per ASN
+    probe_index = probes if isinstance(probes, statistics.ProbeIndex) else statistics.ProbeIndex(probes)
     probe_set = {"probes": [], "addresses": [], "asn": []}
     for asn in asn_list:
-        probe_candidates = statistics.get_example_set_by_asn(probes, asn, ip_version)
+        probe_candidates = statistics.get_example_set_by_asn(probe_index, asn, ip_version)
         if probe_candidates.get('probes'):
             # just take first probe candidate
             probe_set["probes"].append(probe_candidates.get('probes')[0])
@@ -215,6 +234,14 @@ def parse_args():
         help='Set measurement country if multi measurement (allowed = germany, usa, russia, russia-censored; default = germany)'
     )
 
+    parser.add_argument('-k', '--credits', type=int, default=None,
+        help='RIPE Atlas credits the measurements may use at most (default = no limit)'
+    )
+
+    parser.add_argument('-r', '--resume', type=str, default=None, metavar='RUN',
+        help='Continue the interrupted run RUN (its directory, or its name in basedir) instead of starting a new one'
+    )
+
     parser.add_argument('-d', '--debug', action='store_true', default=False, help='Enable debug printing')
     args = parser.parse_args()
     basedir = pathlib.Path(args.basedir)
@@ -227,13 +254,35 @@ def parse_args():
     if args.multi:
         mode = 'multi'
 
-    return basedir, mode, ip_version, args.country, args.debug
+    return basedir, mode, ip_version, args.country, args.debug, args.credits, args.resume
+
+
+def resume(basedir, run, debug):
+    base_path = pathlib.Path(run)
+    if not base_path.is_dir():
+        base_path = basedir.joinpath(run)
+    if not journal.journal_filename(base_path).is_file():
+        exit(f"{base_path} is not a run that can be resumed (no {journal.JOURNAL_FILENAME})")
+
+    set_global_file_logger(base_path.joinpath("run.log"), debug=debug, append=True)
+    logging.info(f'Resuming run {base_path.name}')
+
+    # everything up to the measurement definitions is done, continue polling and starting what is left
+    scheduler, planned_measurements = resume_measurements(str(base_path))
+    scheduler = start_executing_measurements(planned_measurements, str(base_path), scheduler)
+    download_results(scheduler)
+
+    logging.info("Run stopped")
 
 
 def main():
     dateformat = "%Y%m%d-%H%M%S"
 
-    basedir, mode, ip_version, country, debug = parse_args()
+    basedir, mode, ip_version, country, debug, credit_budget, resume_run = parse_args()
+
+    if resume_run:
+        resume(basedir, resume_run, debug)
+        return
 
     # Create standardized result folder
     now_string = datetime.now().strftime(dateformat)
@@ -271,6 +320,7 @@ def main():
     logging.info(f'IP version {ip_version}')
 
     # ADD MEASUREMENT DATA
+    probe_index = statistics.ProbeIndex(probes) if mode == "multi" else None
     c_as = {}
     if mode == "single":
         # 2020
@@ -318,7 +368,7 @@ def main():
         # just add everything - the more results the better... we filter for available probes (ipv4/ipv6) anyway! 
         country_top = set(country_top_v4.get(client_country, set()) | country_top_v6.get(client_country, set()) | country_top_historical.get(client_country, set()))
 
-        c_as = build_probe_set_for_asn(probes, country_top, ip_version)
+        c_as = build_probe_set_for_asn(probe_index, country_top, ip_version)
 
     else:
         exit("unknown mode")
@@ -363,7 +413,7 @@ def main():
         if country == "russia-censored":
             destination_set = russia_censored_v4
 
-        d_as = build_probe_set_for_asn(probes, destination_set, ip_version)
+        d_as = build_probe_set_for_asn(probe_index, destination_set, ip_version)
     else:
         logging.error(f'Selected unknown mode "{mode}"')
         exit(1)
@@ -371,9 +421,10 @@ def main():
     # logging.info("destination set set to %s" % d_as)
     # CREATE SETS
     measurement_sets = create_sets_f(details, probes, c_as, d_as, base_path, ip_version)
-    measurement_definitions = create_measurement_definitions(measurement_sets, now_string, base_path, ip_version)
-    measurement_responses = start_executing_measurements(measurement_definitions, base_path)
-    download_results(measurement_responses, base_path)
+    planned_measurements = create_measurement_definitions(measurement_sets, now_string, base_path, ip_version,
+                                                          credit_budget)
+    scheduler = start_executing_measurements(planned_measurements, base_path)
+    download_results(scheduler)
 
     logging.info("Run stopped")
 
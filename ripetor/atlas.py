@@ -1,10 +1,19 @@
 import argparse
+import asyncio
 import json
 import logging
 import os
 import pathlib
 import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from ripetor import results
+except:
+    import results
 
 BASE_URL = "https://atlas.ripe.net/api/v2/measurements/"  # "https://webhook.site/8d482d35-ee70-4d12-a4d2-1428fa32813d/"
 API_KEY = os.getenv("RIPE_KEY")
@@ -13,31 +22,216 @@ if API_KEY is None:
     logging.error("No API key found at env variable 'RIPE_KEY'")
     exit(1)
 
+MAX_MEASUREMENTS = 100
+
+# A started measurement is polled after MIN_POLL_SECONDS, the interval doubles up to MAX_POLL_SECONDS
+# while its result does not change. It is complete once all requested probes answered or RIPE Atlas no
+# longer reports it as running. Missing probes are waited for at most QUIET_SECONDS after the last new
+# result (probes of many-to-one measurements report minutes apart). DRAIN_TIMEOUT_SECONDS after the last
+# start the rest is given up, a request that found no free slots within SLOT_TIMEOUT_SECONDS is not started.
+MIN_POLL_SECONDS = 10
+MAX_POLL_SECONDS = 120
+QUIET_SECONDS = 300
+DRAIN_TIMEOUT_SECONDS = 600
+SLOT_TIMEOUT_SECONDS = 1800
+
+# Connections kept open to RIPE Atlas, which also bounds the number of concurrent calls of a fan out
+MAX_CONNECTIONS = 16
+# Rate limited (429) and failed (5xx) calls are retried after RETRY_SECONDS, doubled for every retry,
+# unless the response says how long to wait (Retry-After)
+MAX_RETRIES = 4
+# (connect, read) seconds, a call that hangs is retried like a dropped connection
+REQUEST_TIMEOUT = (10, 60)
+RETRY_SECONDS = 1
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# A POST that failed on the server may have created the measurements anyway, so only retry it when rate limited
+IDEMPOTENT_METHODS = ("GET", "PATCH", "DELETE")
+
+# Status ids of measurements that are not done yet (0: Specified, 1: Scheduled, 2: Ongoing)
+RUNNING_STATUS = (0, 1, 2)
+# Measurements whose status is asked for with one listing request (the ids go into the query string)
+STATUS_BATCH_SIZE = 100
+
+
+class AtlasClient:
+    """
+    RIPE Atlas measurement API over one pooled keep-alive session
+
+    The API key is sent in the Authorization header, so it never shows up in URLs and the log. The calls
+    retry rate limited and failed requests. gather runs one call for many measurements concurrently (at
+    most max_connections at a time), e.g. gather(client.retrieve_measurement, ids).
+    """
+
+    def __init__(self, base_url=BASE_URL, api_key=API_KEY, max_connections=MAX_CONNECTIONS):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.session = requests.Session()
+        if api_key:
+            self.session.headers["Authorization"] = "Key " + api_key
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="atlas")
+
+    def request(self, method, path, **kwargs):
+        """Send a request to base_url + path, retrying 429/5xx answers, dropped connections and timeouts"""
+        url = self.base_url + path
+        kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+        for retry in range(MAX_RETRIES + 1):
+            retryable = method in IDEMPOTENT_METHODS
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not retryable or retry == MAX_RETRIES:
+                    raise
+                response, reason = None, type(e).__name__
+            else:
+                retryable = response.status_code == 429 or (retryable and response.status_code in RETRY_STATUS)
+                if not retryable or retry == MAX_RETRIES:
+                    return response
+                reason = response.status_code
+
+            delay = RETRY_SECONDS * 2 ** retry
+            if response is not None and response.headers.get("Retry-After", "").isdigit():
+                delay = int(response.headers["Retry-After"])
+            logging.info(f"{method} {path} failed ({reason}), retry in {delay} seconds")
+            time.sleep(delay)
+
+    async def gather_async(self, call, items):
+        """Run call(item) for all items concurrently, returns the results in the order of items"""
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*(loop.run_in_executor(self.executor, call, item) for item in items))
+
+    def gather(self, call, items):
+        """Blocking version of gather_async"""
+        items = list(items)
+        if len(items) <= 1:
+            return [call(item) for item in items]
+        return asyncio.run(self.gather_async(call, items))
+
+    def start_definition(self, definition):
+        logging.info("Start definition")
+        response = self.request("POST", "", json=definition)
+        if response.ok:
+            logging.info("  response okay")
+            return response.json()
+        else:
+            logging.error(response.content)
+
+    def get_measurements_running(self):
+        logging.debug("GET " + self.base_url + "my?status=0,1,2")
+        response = self.request("GET", "my?status=0,1,2")
+        if response.ok:
+            c = response.json()
+            logging.debug(c)
+            return c
+        else:
+            logging.error(response.content)
+            raise RuntimeError
+
+    def get_measurement_status(self, measurement_id, update=False):
+        measurement_id = str(measurement_id)
+        measurement_id = measurement_id.strip()
+
+        if update:
+            response = self.request("PATCH", measurement_id)
+            if response.status_code != 200:
+                return None
+
+        response = self.request("GET", measurement_id)
+        if response.status_code != 200:
+            return None
 
-def start_definition(definition):
-    logging.info("Start definition")
-    response = requests.post(BASE_URL + "?key=" + API_KEY, json=definition)
-    if response.ok:
-        logging.info("  response okay")
         return response.json()
-    else:
-        logging.error(response.content)
+
+    def get_measurement_statuses(self, measurement_ids, update=False):
+        """
+        Status ids of many measurements of this account, fetched in batches from the paginated listing
+
+        Returns a dict measurement id -> status id, measurements that could not be looked up are missing.
+        If update is set to True, it will also send a PATCH before to request a status update.
+        """
+        measurement_ids = [int(str(m_id).strip()) for m_id in measurement_ids]
+        if update:
+            self.gather(self.update_measurement, measurement_ids)
+
+        statuses = {}
+        for i in range(0, len(measurement_ids), STATUS_BATCH_SIZE):
+            batch = measurement_ids[i:i + STATUS_BATCH_SIZE]
+            params = {"id__in": ",".join(map(str, batch)), "fields": "id,status",
+                      "page_size": STATUS_BATCH_SIZE, "page": 1}
+            while True:
+                logging.debug(f"GET {self.base_url}my?id__in=... ({len(batch)} ids, page {params['page']})")
+                response = self.request("GET", "my", params=params)
+                if not response.ok:
+                    logging.error(f"Could not get the status of {len(batch)} measurements")
+                    logging.error(response.content)
+                    break
+                page = response.json()
+                for m in page["results"]:
+                    statuses[m["id"]] = m["status"]["id"]
+                if not page.get("next"):
+                    break
+                params["page"] += 1
+        return statuses
+
+    def measurement_not_running(self, measurement_id):
+        response = self.request("GET", str(measurement_id))
+
+        if response.ok:
+            r = response.json()
+
+            # id (integer): Numeric ID of this status
+            # 0: Specified, 1: Scheduled, 2: Ongoing,
+            # 4: Stopped, 5: Forced to stop, 6: No suitable probes, 7: Failed, 8: Archived
+            if r["status"]["id"] not in RUNNING_STATUS:
+                return True
+            else:
+                return False
+
+    def retrieve_measurement(self, measurement_id, start=None):
+        """Results of a measurement, only those from start (unix timestamp) on if given"""
+        path = str(measurement_id) + "/results/" + (f"?start={start}" if start is not None else "")
+        logging.debug("GET " + self.base_url + path)
+        response = self.request("GET", path)
+        if response.ok:
+            result = response.json()
+            return result
+        else:
+            logging.error(f"{measurement_id} - HTTP Error {response.status_code}")
+            logging.error(response.content)
+
+    def stop_measurement(self, measurement_id):
+        logging.debug("DELETE " + self.base_url + str(measurement_id))
+        response = self.request("DELETE", str(measurement_id))
+        if response.ok:
+            logging.debug("measurement %d deleted", measurement_id)
+            logging.debug(response.content)
+        else:
+            logging.warning(f"{measurement_id} measurement delete error, maybe cannot be deleted")
+            logging.warning(response.content)
+
+    def update_measurement(self, measurement_id):
+        logging.debug("PATCH " + self.base_url + str(measurement_id))
+        response = self.request("PATCH", str(measurement_id), json={"is_public": True})
+        if response.ok:
+            logging.debug(f"Measurement {measurement_id} patched")
+        else:
+            logging.error(f'Could not PATCH existing measurement:')
+            logging.error(response.content)
 
 
-WAIT_TIME_SECONDS = 40
-MAX_MEASUREMENTS = 100
+# shared by the module functions below, replace it to talk to another endpoint
+client = AtlasClient()
+
+
+def start_definition(definition):
+    return client.start_definition(definition)
 
 
 def get_measurements_running():
-    logging.debug("GET " + BASE_URL + "my?status=0,1,2")
-    response = requests.get(BASE_URL + "my?key=%s&status=0,1,2" % API_KEY)
-    if response.ok:
-        c = response.json()
-        logging.debug(c)
-        return c
-    else:
-        logging.error(response.content)
-        raise RuntimeError
+    return client.get_measurements_running()
 
 
 def any_measurement_running():
@@ -53,194 +247,252 @@ def get_measurement_status(measurement_id, update=False):
     retrieves the status of the given measurement and returns the json if status == 200 otherwise None
     if update is set to True, it will also send a PATCH before to request a status update
     """
-    measurement_id = str(measurement_id)
-    measurement_id = measurement_id.strip()
-    api_url = f'{BASE_URL}{measurement_id}'
+    return client.get_measurement_status(measurement_id, update)
 
-    if update:
-        patch_url = f'{api_url}?key={API_KEY}'
-        response = requests.patch(patch_url)
-        if response.status_code != 200:
-            return None
-
-    response = requests.get(api_url)
-    if response.status_code != 200:
-        return None
 
-    return response.json()
+def get_measurement_statuses(measurement_ids, update=False):
+    """Status ids of many measurements by id, with a few listing requests instead of one GET each"""
+    return client.get_measurement_statuses(measurement_ids, update)
 
 
 def measurement_not_running(measurement_id):
-    response = requests.get(BASE_URL + str(measurement_id))
+    return client.measurement_not_running(measurement_id)
 
-    if response.ok:
-        r = response.json()
 
-        # id (integer): Numeric ID of this status
-        # 0: Specified, 1: Scheduled, 2: Ongoing,
-        # 4: Stopped, 5: Forced to stop, 6: No suitable probes, 7: Failed, 8: Archived
-        if r["status"]["id"] not in (0, 1, 2):
-            return True
-        else:
-            return False
+def measurements_not_running(measurement_ids):
+    """measurement_not_running for many measurements at once, False for the ones without status"""
+    statuses = get_measurement_statuses(measurement_ids)
+    return [statuses.get(int(m_id), RUNNING_STATUS[0]) not in RUNNING_STATUS for m_id in measurement_ids]
 
 
-def retrieve_measurement(measurement_id):
-    logging.debug("GET " + BASE_URL + str(measurement_id) + "/results/")
-    response = requests.get(BASE_URL + str(measurement_id) + "/results/")
-    if response.ok:
-        result = response.json()
-        return result
-    else:
-        logging.error(f"{measurement_id} - HTTP Error {response.status_code}")
-        logging.error(response.content)
+def retrieve_measurement(measurement_id, start=None):
+    return client.retrieve_measurement(measurement_id, start)
+
+
+def retrieve_new_results(base_dir, case, m_id):
+    """Results of a measurement from shortly before the newest one stored in base_dir on"""
+    return retrieve_measurement(m_id, results.open_log(results.result_filename(base_dir, case, m_id)).window_start())
 
 
 def stop_measurement(measurement_id):
-    logging.debug("DELETE " + BASE_URL + str(measurement_id))
-    response = requests.delete(BASE_URL + str(measurement_id) + "?key=%s" % API_KEY)
-    if response.ok:
-        logging.debug("measurement %d deleted", measurement_id)
-        logging.debug(response.content)
-    else:
-        logging.warning(f"{measurement_id} measurement delete error, maybe cannot be deleted")
-        logging.warning(response.content)
+    client.stop_measurement(measurement_id)
 
 
 def update_measurement(measurement_id):
     """Do this because RIPE Atlas sometimes does not update the measurement status until PATCH"""
-    logging.debug("PATCH " + BASE_URL + str(measurement_id))
-    response = requests.patch(BASE_URL + str(measurement_id) + "?key=%s" % API_KEY, json={"is_public": True})
-    if response.ok:
-        logging.debug(f"Measurement {measurement_id} patched")
-    else:
-        logging.error(f'Could not PATCH existing measurement:')
-        logging.error(response.content)
+    client.update_measurement(measurement_id)
+
 
+def save_result(base_dir, case, m_id, m_json):
+    """
+    Append the new results of a measurement to base_dir/case/<id>.jsonl
+
+    Returns True if there were new results, False if nothing changed since the last download and None if
+    there was nothing to store yet.
+    """
+    # check if we actually got a result
+    if m_json is None:
+        logging.warning(f'Could not download measurement result {m_id}')
+        return None
+    elif not isinstance(m_json, list):
+        return None
+
+    log = results.open_log(results.result_filename(base_dir, case, m_id))
+    new_results = log.append(m_json)
+    if new_results:
+        logging.debug(f'{m_id}: {new_results} new results for {case} ({len(log)} total)')
+        return True
+    # apparently an empty result happens more often than thought, no logging for it
+    return False if len(log) else None
 
-def update_downloaded_finished(measurement_responses):
-    for m_id in measurement_responses["downloaded"]:
-        # Check status
-        # ... if still active, kill it again and patch it
-        # ... if already stopped, move to finished
 
-        if measurement_not_running(m_id):
-            # Perfect .. move it
-            measurement_responses["finished"].append(m_id)
-        else:
-            # Send DELETE again
-            stop_measurement(m_id)
-            # Send PATCH to update the current status as RIPE does not keep status continuously updated
-            update_measurement(m_id)
+class TrackedMeasurement:
+    """Polling state of one started measurement: running -> downloaded (stop sent) -> finished"""
 
-    # Update downloaded list to remove the ones that have been finished
-    measurement_responses["downloaded"] = [m for m in measurement_responses["downloaded"] if m not in measurement_responses["finished"]]
+    def __init__(self, m_id, case, now, requested=None):
+        self.id = m_id
+        self.case = case
+        # number of probes asked for, unknown for the measurements of a resumed run
+        self.requested = requested
+        self.state = "running"
+        # the next download fetches all results instead of the window after the newest stored one
+        self.full_fetch = False
+        self.last_change = now
+        self.interval = MIN_POLL_SECONDS
+        self.next_poll = now + self.interval
 
+    def poll_soon(self, now):
+        self.interval = MIN_POLL_SECONDS
+        self.next_poll = now + self.interval
 
-def download_everything(base_dir, measurement_responses):
+    def back_off(self, now):
+        self.interval = min(self.interval * 2, MAX_POLL_SECONDS)
+        self.next_poll = now + self.interval
+
+
+class MeasurementScheduler:
     """
-    Will try to download all running measurements exactly one time.
-    This method will NOT retry to download, call method multiple times with some delay.
-    Will do some housekeeping to keep track of running, downloaded and finished measurements.
+    Start measurement definitions as soon as slots are free and download their results
+
+    Each started measurement is polled on its own schedule: shortly after the start and again soon while
+    its result grows, with exponential backoff while nothing arrives. It is complete once every requested
+    probe answered, or its result did not change for QUIET_SECONDS: then it is stopped and polled (with
+    backoff) until RIPE Atlas no longer reports it as running, which frees its slot. A measurement that
+    RIPE Atlas reports as ended (done, failed, no suitable probes, stopped) frees its slot right away, one
+    without any results is given up. Slots are counted for the measurements started here, so nothing
+    else should be running on the account (ripetor.py checks that before it starts).
+
+    measurement_responses ({case: running ids, "downloaded": stopped ids, "finished": ids}) is kept up to
+    date, measurements it already holds as running or downloaded (a resumed run) are tracked from the start.
+    Every change is also recorded in the journal (a journal.CampaignJournal), if given.
     """
-    base_path = pathlib.Path(base_dir)
-    downloaded_files = 0
-
-    # Check all measurements that have already been downloaded
-    update_downloaded_finished(measurement_responses)
-
-    for case, m_id_list in measurement_responses.items():
-        # ignore helper categories
-        if case in ["downloaded", "finished"]:
-            continue
-
-        # create our case directory from the base path
-        case_dir = base_path.joinpath(case)
-        case_dir.mkdir(parents=True, exist_ok=True)
-
-        for m_id in m_id_list:
-            # Replaced: fn = base_dir + "/" + case + "/" + str(m_id) + ".json"
-            # Build filepath from case path
-            file_name = str(m_id).strip()
-            fn = case_dir.joinpath(f'{file_name}.json')
-
-            # Grab the results for this measurement
-            m_json = retrieve_measurement(m_id)
-            # check if we actually got a result
-            if m_json is None:
-                logging.warning(f'Could not download measurement result {m_id}')
-                continue
-            elif isinstance(m_json, list) and len(m_json) == 0:
-                # Removing logging for empty result, this just spams the console
-                # apparently this case happens more often than thought
-                # logging.warning(f'Got empty result for {m_id}')
+
+    def __init__(self, result_dir, measurement_responses, max_measurements=MAX_MEASUREMENTS, journal=None):
+        self.result_dir = result_dir
+        self.measurement_responses = measurement_responses
+        self.max_measurements = max_measurements
+        self.journal = journal
+        self.tracked = {}
+
+        now = time.monotonic()
+        for case, m_id_list in measurement_responses.items():
+            if case == "finished":
                 continue
+            for m_id in m_id_list:
+                m = self.tracked[m_id] = TrackedMeasurement(m_id, case, now)
+                if case == "downloaded":
+                    m.state = "downloaded"
+
+    def _record(self, event, **fields):
+        if self.journal is not None:
+            self.journal.record(event, **fields)
+
+    def start(self, case, definition, part=None):
+        """Start a definition and track its measurements, returns the response (None on errors)"""
+        self._record("starting", case=case, part=part)
+        response = start_definition(definition)
+        if response is None:
+            return None
+        now = time.monotonic()
+        requested = sum(p["requested"] for p in definition["probes"])
+        for m_id in response["measurements"]:
+            self.tracked[m_id] = TrackedMeasurement(m_id, case, now, requested)
+        self.measurement_responses[case].extend(response["measurements"])
+        self._record("started", case=case, part=part, measurements=response["measurements"])
+        return response
+
+    def wait_for_slots(self, nr_measurement, timeout=SLOT_TIMEOUT_SECONDS):
+        """
+        Poll until nr_measurement more measurements fit into max_measurements or timeout seconds passed
+
+        Returns whether they fit.
+        """
+        deadline = time.monotonic() + timeout
+        while self.tracked and len(self.tracked) + nr_measurement > self.max_measurements:
+            if time.monotonic() >= deadline:
+                return False
+            logging.debug(f'{len(self.tracked)} running and {nr_measurement} to start')
+            self.step(deadline)
+        return True
 
-            # If we already have downloaded some results for a measurement,
-            # open the existing file and compare the results
-            # if there are more responses in the new file than in the old one, keep the measurement as active
-            # i.e. do not add the measurement into the downloaded helper category
-            # if however we have the same number of results, we add the measurement to the downloaded category
-            # thus sending a stop measurement to ripe
-            if fn.is_file():
-                # Should not happen anymore except for case2 and case4
-                # if case in ("case1", "case3"):
-                #     logging.warning("... check measurement for  %d ... exists" % m_id)
-                #     measurement_responses["downloaded"].append(m_id)
-                # else:
-                logging.info(f'{m_id}: Updating existing result for {case}')
-
-                with open(fn, "r+") as fp:
-                    res_old = json.load(fp)
-                    logging.debug(f'{m_id}: res old - new: {len(res_old)} - {len(m_json)}')
-
-                    if isinstance(m_json, list) and len(m_json) > len(res_old):
-                        # New result is larger than old one, keep the measurement as active
-                        # Do NOT mark the measurement as downloaded or something
-                        fp.seek(0)
-                        json.dump(m_json, fp, indent=2)
-                        fp.truncate()
-                    elif isinstance(m_json, list) and len(m_json) == len(res_old):
-                        # Result did not change, add to downloaded list
-                        stop_measurement(m_id)
-                        measurement_responses["downloaded"].append(m_id)
+    def drain(self, timeout=DRAIN_TIMEOUT_SECONDS):
+        """Poll until all measurements finished or timeout seconds passed, returns the ids still running"""
+        deadline = time.monotonic() + timeout
+        while self.tracked and time.monotonic() < deadline:
+            self.step(deadline)
+        return list(self.tracked)
+
+    def step(self, deadline=None):
+        """Poll the measurements that are due or sleep until the next one is"""
+        now = time.monotonic()
+        due = [m for m in self.tracked.values() if m.next_poll <= now]
+        if not due:
+            wake_up = min(m.next_poll for m in self.tracked.values())
+            if deadline is not None:
+                wake_up = min(wake_up, deadline)
+            time.sleep(max(0, wake_up - now))
+            return
+
+        # fetch everything that is due at once, then process the answers one by one
+        running = [m for m in due if m.state == "running"]
+        downloaded = [m for m in due if m.state != "running"]
+        # the status is asked before the download, so a result that came in just before the end is not missed
+        not_running = measurements_not_running([m.id for m in running + downloaded])
+        ended = {m.id for m, m_not_running in zip(running, not_running) if m_not_running}
+        not_running = not_running[len(running):]
+        new_results = client.gather(lambda m: retrieve_measurement(m.id) if m.full_fetch
+                                    else retrieve_new_results(self.result_dir, m.case, m.id), running)
+
+        complete = [m.id for m, m_json in zip(running, new_results) if self._poll_running(m, m_json, m.id in ended)]
+        still_running = [m.id for m, m_not_running in zip(downloaded, not_running)
+                         if self._poll_downloaded(m, m_not_running)]
+
+        # Send DELETE for the complete ones, again for those still running and PATCH to update their status
+        # as RIPE does not keep it continuously updated
+        client.gather(stop_measurement, complete + still_running)
+        client.gather(update_measurement, still_running)
+
+    def _poll_running(self, m, m_json, ended=False):
+        """
+        Process a downloaded result, returns True if the measurement is complete and has to be stopped
+
+        ended tells that RIPE Atlas no longer reports the measurement as running.
+        """
+        changed = save_result(self.result_dir, m.case, m.id, m_json)
+        now = time.monotonic()
+        if m_json is None:
+            m.back_off(now)
+            return False
+        if changed:
+            m.last_change = now
+
+        log = results.open_log(results.result_filename(self.result_dir, m.case, m.id))
+        answered = m.requested is not None and log.probe_count() >= m.requested
+        # a measurement without any result yet is only given up once it ended
+        quiet = len(log) and now - m.last_change >= QUIET_SECONDS
+        if not (ended or answered or quiet):
+            # probes are missing, poll soon while results come in and back off while nothing arrives
+            m.full_fetch = False
+            if changed:
+                m.poll_soon(now)
             else:
-                # Found result for measurement, download it
-                logging.debug("write result %s %d" % (case, m_id))
-                with open(fn, "w") as f:
-                    json.dump(m_json, f, indent=2)
-                    downloaded_files += 1
-
-                # logging.info(f'{m_id} ({case}) Stopping Measurement')
-                # Quick Hack, I want case 2 and case4 to be checked more often
-                # TODO If CAS OR DAS > 1
-                # if case in ("case1", "case3"):
-                #     stop_measurement(m_id)
-                #     measurement_responses["downloaded"].append(m_id)
-
-        # Update List of still running cases within each case
-        measurement_responses[case] = [m for m in m_id_list if m not in measurement_responses["downloaded"]]
-
-    total_responses = sum(map(len, measurement_responses.values()))
-    logging.info(f"Downloaded {downloaded_files} new files (from {total_responses} responses at this time)")
-
-
-def wait_and_download(result_dir, measurement_responses, nr_measurement=0):
-    if nr_measurement:
-        # MM: get ALL running measurements on the given API key
-        # this does also include non-involved measurements
-        running = get_measurements_running()
-        while running["count"] + nr_measurement > MAX_MEASUREMENTS:
-            logging.info(
-                f'Waiting {WAIT_TIME_SECONDS} seconds; {running["count"]} running and {nr_measurement} to start'
-            )
-            time.sleep(WAIT_TIME_SECONDS)
-
-            # MM: Try to download all currently running measurements
-            download_everything(result_dir, measurement_responses)
-
-            running = get_measurements_running()
-    logging.info(" ... finished waiting")
+                m.back_off(now)
+            return False
+        if not m.full_fetch:
+            # a probe that uploaded its result long after its timestamp is outside the download window,
+            # fetch everything once more (stored results are skipped) before the measurement is let go
+            m.full_fetch = True
+            m.poll_soon(now)
+            return False
+
+        self.measurement_responses[m.case].remove(m.id)
+        if ended:
+            # Done, failed, no suitable probes or stopped by RIPE Atlas, it has no slot anymore
+            if not len(log):
+                logging.warning(f'{m.id} ended without results, giving up')
+            self.measurement_responses["finished"].append(m.id)
+            self._record("ended", case=m.case, id=m.id)
+            del self.tracked[m.id]
+            return False
+        # All probes answered or the rest did not for long enough, the measurement gets stopped and we wait
+        # until RIPE Atlas agrees
+        m.state = "downloaded"
+        self.measurement_responses["downloaded"].append(m.id)
+        self._record("downloaded", case=m.case, id=m.id)
+        m.poll_soon(now)
+        return True
+
+    def _poll_downloaded(self, m, not_running):
+        """Process a status check, returns True if the measurement is still running and has to be stopped again"""
+        if not_running:
+            logging.debug(f'{m.id} finished')
+            self.measurement_responses["downloaded"].remove(m.id)
+            self.measurement_responses["finished"].append(m.id)
+            self._record("finished", id=m.id)
+            del self.tracked[m.id]
+            return False
+        m.back_off(time.monotonic())
+        return True
 
 
 def kill_all_running_measurements():
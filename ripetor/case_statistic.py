@@ -0,0 +1,93 @@
+"""
+Probabilities of the routes of a case as a sparse target x AS x relay AS tensor
+
+For every target (the origin or destination AS of the measurements of a case) analyze_case finds the ASes on
+its routes and the AS of the relay each route leads to. The probability of such a cell is the guard or exit
+probability of the relay AS. Only existing cells are kept, as four equally long numpy arrays: the ASNs of
+target, AS on the route and relay AS, and the probability. A row is the cells of one (target, AS) pair.
+"""
+import numpy as np
+
+# target of the cells of all targets combined, see CaseStatistic.with_maxand
+MAXAND = -1
+
+
+def target_name(target):
+    return "MAXAND" if target == MAXAND else "AS%d" % target
+
+
+def _max_cells(targets, asns, relays, probabilities):
+    """Statistic with the largest probability of every cell, ordered by ASNs"""
+    if not len(targets):
+        return CaseStatistic()
+    cells, inverse = np.unique(np.stack([targets, asns, relays], axis=1), axis=0, return_inverse=True)
+    combined = np.zeros(len(cells))
+    np.maximum.at(combined, inverse.reshape(-1), probabilities)
+    return CaseStatistic(cells[:, 0], cells[:, 1], cells[:, 2], combined)
+
+
+class CaseStatistic:
+
+    def __init__(self, targets=(), asns=(), relays=(), probabilities=()):
+        self.targets = np.asarray(targets, dtype=np.int64)
+        self.asns = np.asarray(asns, dtype=np.int64)
+        self.relays = np.asarray(relays, dtype=np.int64)
+        self.probabilities = np.asarray(probabilities, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def target_asns(self):
+        """Targets in the order they first appear"""
+        _, first = np.unique(self.targets, return_index=True)
+        return self.targets[np.sort(first)].tolist()
+
+    def select(self, target):
+        """Statistic of the cells of one target"""
+        cells = self.targets == target
+        return CaseStatistic(self.targets[cells], self.asns[cells], self.relays[cells], self.probabilities[cells])
+
+    def combine_max(self, other):
+        """Cells of both statistics, the larger probability where both have a cell, ordered by ASNs"""
+        return _max_cells(np.concatenate([self.targets, other.targets]), np.concatenate([self.asns, other.asns]),
+                          np.concatenate([self.relays, other.relays]),
+                          np.concatenate([self.probabilities, other.probabilities]))
+
+    def with_maxand(self):
+        """The statistic plus the MAXAND target: for every AS and relay AS the largest probability of any target"""
+        maxand = _max_cells(np.full(len(self), MAXAND), self.asns, self.relays, self.probabilities)
+        return CaseStatistic(np.concatenate([self.targets, maxand.targets]),
+                             np.concatenate([self.asns, maxand.asns]),
+                             np.concatenate([self.relays, maxand.relays]),
+                             np.concatenate([self.probabilities, maxand.probabilities]))
+
+    def rows(self):
+        """
+        Sums of the (target, AS) rows in the order they first appear
+
+        Returns the target and AS of every row, its total probability, its number of routes with a
+        probability above 0 and for every cell the index of its row.
+        """
+        if not len(self):
+            return [], [], [], [], np.zeros(0, dtype=np.int64)
+        _, first, inverse = np.unique(np.stack([self.targets, self.asns], axis=1), axis=0,
+                                      return_index=True, return_inverse=True)
+        order = np.argsort(first, kind="stable")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        row = rank[inverse.reshape(-1)]
+
+        # bincount adds the cells of a row in their order, the sums are those of the dict based statistics
+        totals = np.bincount(row, weights=self.probabilities, minlength=len(order))
+        routes = np.bincount(row, weights=self.probabilities > 0, minlength=len(order))
+        first = first[order]
+        return self.targets[first].tolist(), self.asns[first].tolist(), totals.tolist(), \
+            routes.astype(np.int64).tolist(), row
+
+    def to_dict(self):
+        """Nested dicts target -> AS -> relay AS -> probability with "AS<number>" keys"""
+        stat = dict()
+        for target, asn, relay, probability in zip(self.targets.tolist(), self.asns.tolist(), self.relays.tolist(),
+                                                   self.probabilities.tolist()):
+            stat.setdefault(target_name(target), dict()).setdefault("AS%d" % asn, dict())["AS%d" % relay] = probability
+        return stat
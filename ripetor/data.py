@@ -2,57 +2,365 @@ import os
 import requests
 import json
 import bz2
-import gzip
+import zlib
+import hashlib
+import shutil
 import logging
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+
+try:
+    from ripetor import ip2as
+except:
+    import ip2as
 
 DETAILS_ULR = "https://onionoo.torproject.org/details"
 PROBES_URL = "https://ftp.ripe.net/ripe/atlas/probes/archive/meta-latest"
 IP2ASN_V4_URL = "https://iptoasn.com/data/ip2asn-v4.tsv.gz"
 IP2ASN_V6_URL = "https://iptoasn.com/data/ip2asn-v6.tsv.gz"
 
+CHUNK_SIZE = 1024 * 1024
+# (connect, read) seconds, a stalled download fails after at most read seconds and can be cancelled
+DOWNLOAD_TIMEOUT = (10, 60)
+
+# fields of relays and probes that are used later on, see iter_relays and iter_probes
+RELAY_FIELDS = ("fingerprint", "flags", "as", "or_addresses", "guard_probability", "middle_probability",
+                "exit_probability", "advertised_bandwidth", "last_seen", "country")
+PROBE_FIELDS = ("id", "status_name", "asn_v4", "asn_v6", "address_v4", "address_v6", "prefix_v4", "prefix_v6",
+                "country_code", "total_uptime")
+
+# downloads are shared between runs through this cache, an empty RIPETOR_CACHE disables it
+CACHE_DIR = os.getenv("RIPETOR_CACHE", os.path.expanduser("~/.cache/ripetor"))
+# seconds a cached url is reused without revalidating it with the server
+CACHE_MAX_AGE = int(os.getenv("RIPETOR_CACHE_MAX_AGE", 3600))
+
+
+def decompress_chunks(chunks, new_decompressor):
+    """Decompress an iterable of chunks incrementally, also handles files with several concatenated streams"""
+    decompressor = new_decompressor()
+    for chunk in chunks:
+        while chunk:
+            yield decompressor.decompress(chunk)
+            if not decompressor.eof:
+                break
+            # next stream starts in the unused data of this chunk
+            chunk = decompressor.unused_data
+            decompressor = new_decompressor()
+    if hasattr(decompressor, "flush"):
+        yield decompressor.flush()
+
+
+def save_response(response, filename, new_decompressor=None, cancel=None, digest=None):
+    """
+    Write a streamed response chunk by chunk into filename and return the number of bytes written
+
+    The data is decompressed on the fly if a decompressor factory is given and written to a temporary
+    file, which is renamed to filename once the download is complete.
+    Setting the optional cancel event aborts the download after the current chunk,
+    an optional hashlib object is updated with the written data.
+    """
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix=".part")
+    written = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+            if new_decompressor:
+                chunks = decompress_chunks(chunks, new_decompressor)
+            for chunk in chunks:
+                if cancel is not None and cancel.is_set():
+                    raise RuntimeError("Download of %s cancelled" % response.url)
+                f.write(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                written += len(chunk)
+        os.chmod(tmp_filename, 0o644)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+    return written
+
+
+def stream_download(url, filename, new_decompressor=None, cancel=None):
+    """Download url into filename, see save_response"""
+    with requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        r.raise_for_status()
+        return save_response(r, filename, new_decompressor, cancel)
+
+
+def link_file(source, filename):
+    """Hardlink source to filename, copy it if they are on different file systems"""
+    try:
+        os.link(source, filename)
+    except OSError:
+        shutil.copy2(source, filename)
+
+
+def _read_cache_entry(entry_filename):
+    try:
+        with open(entry_filename, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
 
-def download_details(details_filename):
+def _write_cache_entry(entry_filename, entry):
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(entry_filename), suffix=".part")
+    with os.fdopen(fd, 'w') as f:
+        json.dump(entry, f, indent=2)
+    os.replace(tmp_filename, entry_filename)
+
+
+def cached_download(url, filename, new_decompressor=None, cancel=None):
+    """
+    Download url into filename through the shared dataset cache and return the path of the cached file
+
+    Files are stored by the sha256 of their (decompressed) content and hardlinked into filename,
+    so every run keeps the exact data it used. A cached url younger than CACHE_MAX_AGE is reused
+    without asking the server, older ones are revalidated with ETag/Last-Modified.
+    Without CACHE_DIR this is a plain stream_download.
+    """
+    if not CACHE_DIR:
+        stream_download(url, filename, new_decompressor, cancel)
+        return filename
+
+    object_dir = os.path.join(CACHE_DIR, "objects")
+    url_dir = os.path.join(CACHE_DIR, "urls")
+    os.makedirs(object_dir, exist_ok=True)
+    os.makedirs(url_dir, exist_ok=True)
+
+    entry_filename = os.path.join(url_dir, hashlib.sha256(url.encode()).hexdigest() + ".json")
+    entry = _read_cache_entry(entry_filename)
+    if entry and not os.path.isfile(os.path.join(object_dir, entry["sha256"])):
+        entry = None
+
+    if entry and time.time() - entry["fetched"] < CACHE_MAX_AGE:
+        logging.info("Using cached %s (sha256 %s)" % (url, entry["sha256"]))
+    else:
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        with requests.get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT) as r:
+            if r.status_code == 304:
+                logging.info("Cached %s is still current (sha256 %s)" % (url, entry["sha256"]))
+            else:
+                r.raise_for_status()
+                digest = hashlib.sha256()
+                fd, tmp_object = tempfile.mkstemp(dir=object_dir, suffix=".part")
+                os.close(fd)
+                try:
+                    save_response(r, tmp_object, new_decompressor, cancel, digest)
+                    # run directories link to the object, keep it from being changed through them
+                    os.chmod(tmp_object, 0o444)
+                    os.replace(tmp_object, os.path.join(object_dir, digest.hexdigest()))
+                except BaseException:
+                    if os.path.exists(tmp_object):
+                        os.unlink(tmp_object)
+                    raise
+                entry = {"url": url, "sha256": digest.hexdigest(),
+                         "etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+                logging.info("Downloaded %s into cache (sha256 %s)" % (url, entry["sha256"]))
+        entry["fetched"] = time.time()
+        _write_cache_entry(entry_filename, entry)
+
+    cached_filename = os.path.join(object_dir, entry["sha256"])
+    link_file(cached_filename, filename)
+    return cached_filename
+
+
+def gzip_decompressor():
+    return zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+
+
+def download_details(details_filename, cancel=None):
     logging.info("Downloading details from %s" % DETAILS_ULR)
     if not os.path.isfile(details_filename):
-        r = requests.get(DETAILS_ULR)
-        with open(details_filename, 'wb') as f:
-            f.write(r.content)
+        cached_download(DETAILS_ULR, details_filename, cancel=cancel)
 
 
-def download_probes(probes_filename):
+def download_probes(probes_filename, cancel=None):
     logging.info("Downloading probes from %s" % PROBES_URL)
     if not os.path.isfile(probes_filename):
-        r = requests.get(PROBES_URL)
-        with open(probes_filename, 'wb') as f:
-            unzip = bz2.decompress(r.content)
-            f.write(unzip)
+        cached_download(PROBES_URL, probes_filename, bz2.BZ2Decompressor, cancel=cancel)
 
 
-def download_ip2asn_v4(ip2asn_filename):
-    logging.info("Downloading ip2asn_v4 from %s" % IP2ASN_V4_URL)
+def download_ip2asn(url, ip2asn_filename, version, cancel=None):
     if not os.path.isfile(ip2asn_filename):
-        r = requests.get(IP2ASN_V4_URL)
-        with open(ip2asn_filename, 'wb') as f:
-            unzip = gzip.decompress(r.content)
-            f.write(unzip)
+        cached_filename = cached_download(url, ip2asn_filename, gzip_decompressor, cancel=cancel)
+        # compile the snapshot once for the cached file and share it as well, if it could not be written
+        # (e.g. read only cache or full disk) ip2as.load compiles one from the tsv
+        if ip2as.ensure_snapshot(cached_filename, version) and cached_filename != ip2asn_filename:
+            link_file(cached_filename + ip2as.SNAPSHOT_SUFFIX, ip2asn_filename + ip2as.SNAPSHOT_SUFFIX)
+
 
-def download_ip2asn_v6(ip2asn_filename):
+def download_ip2asn_v4(ip2asn_filename, cancel=None):
+    logging.info("Downloading ip2asn_v4 from %s" % IP2ASN_V4_URL)
+    download_ip2asn(IP2ASN_V4_URL, ip2asn_filename, 4, cancel)
+
+def download_ip2asn_v6(ip2asn_filename, cancel=None):
     logging.info("Downloading ip2asn_v6 from %s" % IP2ASN_V6_URL)
-    if not os.path.isfile(ip2asn_filename):
-        r = requests.get(IP2ASN_V6_URL)
-        with open(ip2asn_filename, 'wb') as f:
-            unzip = gzip.decompress(r.content)
-            f.write(unzip)
+    download_ip2asn(IP2ASN_V6_URL, ip2asn_filename, 6, cancel)
+
+
+def download_concurrently(downloads):
+    """
+    Run several download functions (filename -> function) in parallel threads
+
+    Logs and returns time and size per file. The first failing download is raised right away,
+    all other downloads are cancelled.
+    """
+    cancel = threading.Event()
+    stats = {}
+
+    def timed_download(download_function, filename):
+        start = time.monotonic()
+        download_function(filename, cancel=cancel)
+        stats[filename] = {"seconds": time.monotonic() - start, "bytes": os.path.getsize(filename)}
+        logging.info("Downloaded %s: %d bytes in %.1f seconds" % (filename, stats[filename]["bytes"],
+                                                                 stats[filename]["seconds"]))
+
+    with ThreadPoolExecutor(max_workers=len(downloads)) as executor:
+        futures = [executor.submit(timed_download, download_function, filename)
+                   for filename, download_function in downloads.items()]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                cancel.set()
+                raise future.exception()
+
+    return stats
+
+
+class JsonStream:
+    """Minimal incremental reader that decodes a json document value by value from a file"""
+
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    # characters that can continue a number, e.g. a chunk might end in "1." or "1e"
+    NUMBER_TAIL = re.compile(r'[0-9+\-.eE]*\Z')
+
+    def __init__(self, f):
+        self.f = f
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=None):
+        chunk = self.f.read(size or CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skip whitespace and return the next character"""
+        while True:
+            self.pos = self.WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of json document")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected %r at %r" % (char, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def value(self):
+        """Decode the next complete value, reading more data until it is in the buffer"""
+        self.peek()
+        # double the read size on every retry, so large values are not decoded over and over
+        read_size = CHUNK_SIZE
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number followed by nothing but number characters might continue in the next chunk
+                partial = isinstance(value, (int, float)) and not isinstance(value, bool) \
+                    and self.NUMBER_TAIL.match(self.buffer, end)
+                if not partial or self.eof or not self._fill():
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if not self._fill(read_size):
+                    raise
+                read_size *= 2
+
+
+def iter_json_array(filename, key):
+    """Yield the elements of the array under key of the top level json object one by one"""
+    with open(filename, 'r') as f:
+        yield from read_json_array(f, key)
+
+
+def read_json_array(f, key):
+    """Yield the elements of the array under key of the top level json object read from the file object f"""
+    stream = JsonStream(f)
+    stream.expect("{")
+    while stream.peek() != "}":
+        name = stream.value()
+        stream.expect(":")
+        if name == key:
+            break
+        stream.value()
+        if stream.peek() == ",":
+            stream.pos += 1
+    else:
+        return
+
+    stream.expect("[")
+    if stream.peek() == "]":
+        return
+    while True:
+        yield stream.value()
+        separator = stream.peek()
+        stream.pos += 1
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError("Expected ',' or ']' in array %s" % key)
+
+
+def project(records, fields):
+    """Reduce every record to the given fields"""
+    for record in records:
+        yield {k: record[k] for k in fields if k in record}
+
+
+def iter_relays(filename, fields=RELAY_FIELDS):
+    """Stream the relays of an onionoo details document, reduced to fields (all fields if None)"""
+    relays = iter_json_array(filename, "relays")
+    return relays if fields is None else project(relays, fields)
+
+
+def iter_probes(filename, fields=PROBE_FIELDS):
+    """Stream the probes of a RIPE Atlas probe archive, reduced to fields (all fields if None)"""
+    probes = iter_json_array(filename, "objects")
+    return probes if fields is None else project(probes, fields)
+
 
-def load_details(filename):
+def load_details(filename, fields=None):
+    """Load the details document, with fields just the projected relays are kept ({"relays": [...]})"""
     if not os.path.isfile(filename):
         download_details(filename)
+    if fields:
+        return {"relays": list(iter_relays(filename, fields))}
     with open(filename, 'r') as f:
         return json.load(f)
 
 
-def load_probes(filename):
+def load_probes(filename, fields=None):
+    """Load the probe archive, with fields just the projected probes are kept ({"objects": [...]})"""
     if not os.path.isfile(filename):
         download_probes(filename)
+    if fields:
+        return {"objects": list(iter_probes(filename, fields))}
     with open(filename, 'r') as f:
         return json.load(f)
@@ -1,22 +1,33 @@
 # TODO Refactor messed up file
 import argparse
 import pathlib
+from concurrent.futures import ProcessPoolExecutor
 
-import data
-import ip2as
+import numpy as np
 
 import os
-import json
 import logging
 
 
+# the same import style as the other modules, so hops and the --jobs workers use the lookup attached here
 try:
+    from ripetor import data, case_statistic, hops, ip2as, tracing
     from ripetor.statistics import get_current_relays
 except:
+    import data
+    import case_statistic
+    import hops
+    import ip2as
+    import tracing
     from statistics import get_current_relays
 
 BASE_DIR = "run/"
 
+# above every ASN, to combine a route and an ASN into one sort key
+ASN_LIMIT = 1 << 32
+
+TRACE_FILENAME = "trace.jsonl"
+
 
 def load_as_statistic(details, ipv6=False):
     """Load the AS Statistic from details... Sum up the guard/exit probability from all Relays in one AS"""
@@ -45,18 +56,6 @@ def load_as_statistic(details, ipv6=False):
     return stat
 
 
-def open_result(download_dir, measurement_id):
-    """Helper, opens a single json result"""
-    fn = download_dir + str(measurement_id) + ".json"
-    if not os.path.isfile(fn):
-        logging.error("Measurement File: %s not there" % fn)
-        return {}
-    else:
-        with open(fn) as fp:
-            result = json.load(fp)
-            return result
-
-
 def get_probability_for_route(as_statistic, case, asn):
     """Depending on case, return guard or exit probability of one AS"""
     # case 1 guard probability of IP of relay of as
@@ -68,17 +67,44 @@ def get_probability_for_route(as_statistic, case, asn):
         raise KeyError
 
     if asn in as_statistic[p]:
-        logging.debug("%s %s is %f" % (asn, p, as_statistic[p][asn]))
+        logging.debug("%s %s is %f", asn, p, as_statistic[p][asn])
         return as_statistic[p][asn]
     else:
         logging.warning("ASN %s not in AS Statistic - take 0 probability" % asn)
         return 0
 
 
-def analyze_case(as_statistic, run_name, case):
-    """Load and analyze one full case based on all downloaded results"""
-    result_cnt = 0
+def route_as_sets(store):
+    """
+    ASes on every route of a hop store in the order they appear (source, hops, destination), AS0 left out
 
+    Returns two equally long arrays: the row of the route in store.results and the ASN.
+    """
+    n = len(store)
+    routes = np.concatenate([np.arange(n), store.hops["result"], np.arange(n)])
+    asns = np.concatenate([store.results["src_asn"], store.hops["asn"], store.results["dst_asn"]])
+    # a stable sort keeps source, hops and destination of a route in their order
+    order = np.argsort(routes, kind="stable")
+    routes, asns = routes[order], asns[order]
+    on_route = asns != 0
+    routes, asns = routes[on_route], asns[on_route]
+
+    # first appearance of each AS on a route
+    _, first = np.unique(routes * ASN_LIMIT + asns, return_index=True)
+    first.sort()
+    return routes[first], asns[first]
+
+
+def analyze_case(as_statistic, run_name, case, executor=None):
+    """
+    Load and analyze one full case based on all downloaded results
+
+    The results are read from the hop store of the case, which is built first if needed (by the workers of
+    executor, a process pool, if given). Diagnostics of single routes and ASes only go to the trace and are
+    not computed at all unless tracing is enabled.
+
+    Returns the case_statistic.CaseStatistic of the case, targets are the origin or destination ASes.
+    """
     logging.info("Start analyzing measurement %s %s" % (run_name, case))
 
     measurement_dir = BASE_DIR + '/' + run_name + "/"
@@ -87,83 +113,69 @@ def analyze_case(as_statistic, run_name, case):
     basic_logger = logging.getLogger("basic_logger")
     basic_logger.info("Start " + run_name + " " + case)
 
-    result_filenames = os.listdir(download_dir)
+    store = hops.ensure_case(download_dir, hops.store_dir(measurement_dir, case), executor)
+    msm_ids = store.results["msm_id"]
 
-    basic_logger.info("%d filenames" % len(result_filenames))
+    basic_logger.info("%d filenames" % len(np.unique(msm_ids)))
     # TODO --- basic logger sollte mir die gesammelten größen ausgeben, damit ich verstehe wie die statistik zu rechnen ist....
 
-    logging.info("Found %d results" % len(result_filenames))
-
-    case_statistics = dict()
+    logging.info("Found %d results" % len(store))
 
     # Each measurement has some form of guard or exit probability with that ASN ... that can be calculated
-    for measurement_id in [filename.split(".")[0] for filename in result_filenames]:
-        logging.debug("-" * 50)
-        logging.info("Start Analyzing result %s" % measurement_id)
-
-        results = open_result(download_dir, measurement_id)
-
-        if len(results) > 1:
-            if case in ("case2", "case4"):
-                logging.info("Measurement %s has %d results" % (measurement_id, len(results)))
-            else:
-                logging.warning("Measurement %s has %d results" % (measurement_id, len(results)))
-        elif len(results) == 0:
-            logging.warning("Measurement %s has 0 results")
-
-        # This is necessary for case2 and case4 where all results are in one measurement
-        for result in results:
-            result_cnt += 1
-
-            # Get the ASN set from the traceroute result
-            ip_list = get_asn_set_from_traceroute(result)
-            asn_list = translate_ips_to_asn(ip_list)
-            asn_set = set()
-            asn_uniq_list = [x for x in asn_list if x != "AS0" and not (x in asn_set or asn_set.add(x))]
-
-            ass_logger = logging.getLogger("as_set")
-            ass_logger.info("%s m_id %s - size %d - %s" % (case, measurement_id, len(asn_set), asn_uniq_list))
-
-            # For Case1 and Case3 the probability depends on the Destination
-            if case in ("case1", "case3"):  # Check the AS of the measurement
-                # TODO Check ob mit dst_adr möglich oder anders notwendig
-                route_asn = ip2as.ip2asn(result["dst_addr"])
-                multidestasn = ip2as.ip2asn(result["from"])
-
-                logging.info("%s dst: %15s - ASN: %8s - %s  from: %15s - ASN: %8s - %s" % (case,
-                                                                                           result["dst_addr"], route_asn, ip2as.get_as_name(route_asn)[:20],
-                                                                                           result["from"], multidestasn, ip2as.get_as_name(multidestasn)[:20]))
-
-            # For Case2 and Case4 the probability depends on the From Address
-            elif case in ("case2", "case4"):
-                route_asn = ip2as.ip2asn(result["from"])
-                multidestasn = ip2as.ip2asn(result["dst_addr"])
-
-                logging.info("%s From: %15s - ASN: %8s - %s   dst: %15s - ASN: %8s - %s" % (case,
-                                                                                            result["from"], route_asn, ip2as.get_as_name(route_asn)[:20],
-                                                                                            result["dst_addr"], multidestasn, ip2as.get_as_name(multidestasn)[:20]))
-            else:
-                logging.error("Case Error")
-                raise RuntimeError
-
-            if route_asn == "AS0":
-                logging.warning("Did not find probability for Measurement %s %s" % (case, run_name))
-
-            probability = get_probability_for_route(as_statistic, case, route_asn)
-            logging.info("Probability for %8s-%30s is %f" % (route_asn, ip2as.get_as_name(route_asn)[:30], probability))
-
-            for asn in asn_set:
-                # If AS appears on that route, sum it to the table
-                # if asn in case_statistics:
-                #     case_statistics["asn"] += probability
-
-                case_statistics.setdefault(multidestasn, dict()).setdefault(asn, dict())[route_asn] = probability
-
-    basic_logger.info("Evaluated %d concrete results" % result_cnt)
+    if case in ("case1", "case3"):
+        # case2 and case4 have all results in one measurement
+        measurement_ids, counts = np.unique(msm_ids, return_counts=True)
+        if (counts > 1).any():
+            logging.warning("%d measurements of %s have more than one result" % ((counts > 1).sum(), case))
+        if tracing.enabled():
+            for measurement_id, count in zip(measurement_ids[counts > 1].tolist(), counts[counts > 1].tolist()):
+                tracing.record("results", case=case, msm_id=measurement_id, count=count)
+
+        # For Case1 and Case3 the probability depends on the Destination
+        route_asns, multidest_asns = store.results["dst_asn"], store.results["src_asn"]
+    elif case in ("case2", "case4"):
+        # For Case2 and Case4 the probability depends on the From Address
+        route_asns, multidest_asns = store.results["src_asn"], store.results["dst_asn"]
+    else:
+        logging.error("Case Error")
+        raise RuntimeError
+
+    if (route_asns == 0).any():
+        logging.warning("Did not find probability for %d routes of %s %s" % ((route_asns == 0).sum(), case, run_name))
+
+    routes, asns = route_as_sets(store)
+
+    if tracing.enabled():
+        bounds = np.searchsorted(routes, np.arange(len(store) + 1)).tolist()
+        for route, (msm_id, prb_id, route_asn, multidest_asn) in enumerate(zip(
+                msm_ids.tolist(), store.results["prb_id"].tolist(), route_asns.tolist(), multidest_asns.tolist())):
+            tracing.record("route", case=case, msm_id=msm_id, prb_id=prb_id, relay_asn=route_asn,
+                           multidest_asn=multidest_asn, asns=asns[bounds[route]:bounds[route + 1]].tolist())
+
+    # (origin or destination AS, AS on the route, AS of the relay) in the order they first appear
+    triples = np.stack([multidest_asns[routes], asns, route_asns[routes]], axis=1)
+    _, first = np.unique(triples, axis=0, return_index=True)
+    first.sort()
+
+    triples = triples[first]
+
+    # probability of each relay AS, looked up once in the order they first appear
+    relay_asns, first, relay_index = np.unique(triples[:, 2], return_index=True, return_inverse=True)
+    probabilities = np.zeros(len(relay_asns))
+    for index in np.argsort(first, kind="stable").tolist():
+        route_asn = "AS%d" % relay_asns[index]
+        probabilities[index] = get_probability_for_route(as_statistic, case, route_asn)
+        if tracing.enabled():
+            tracing.record("probability", case=case, relay_asn=route_asn, probability=probabilities[index])
+
+    case_statistics = case_statistic.CaseStatistic(triples[:, 0], triples[:, 1], triples[:, 2],
+                                                   probabilities[relay_index.reshape(-1)])
+
+    logging.info("Probabilities of %d relay ASes" % len(probabilities))
+    basic_logger.info("Evaluated %d concrete results" % len(store))
     return case_statistics
 
 
-
 def write_case_table(run_name, case, as_statistic, multiple_case_stat):
 
 
@@ -175,7 +187,7 @@ def write_case_table(run_name, case, as_statistic, multiple_case_stat):
     else:
         raise KeyError
 
-    for target, case_stat in multiple_case_stat.items():
+    for target, case_stat in multiple_case_stat.to_dict().items():
 
         fn = BASE_DIR + "/" + run_name + "/stat/" + case + "_" + target + "_table.tsv"
         logging.debug("Write %s statistic to %s" % (case, fn))
@@ -204,22 +216,35 @@ def write_case_stats(run_name, case, as_statistic, multiple_case_stat):
     else:
         raise KeyError
 
-    for target, case_stat in multiple_case_stat.items():
+    for target in multiple_case_stat.target_asns():
 
-        fn = BASE_DIR + "/" + run_name + "/stat/" + case + "_" + target + "_stats.tsv"
+        fn = BASE_DIR + "/" + run_name + "/stat/" + case + "_" + case_statistic.target_name(target) + "_stats.tsv"
         logging.debug("Write %s statistic to %s" % (case, fn))
 
+        case_stat = multiple_case_stat.select(target)
+        _, asns, totals, routes, cell_rows = case_stat.rows()
+        asns = ["AS%d" % asn for asn in asns]
+        as_names = dict(zip(asns, ip2as.get_as_names(asns)))
+
+        # routes of every row with a probability above 0
+        route_probabilities = [dict() for _ in asns]
+        for row, relay, probability in zip(cell_rows.tolist(), case_stat.relays.tolist(),
+                                           case_stat.probabilities.tolist()):
+            if probability > 0:
+                route_probabilities[row]["AS%d" % relay] = "%8f" % probability
+
         with open(fn, "w") as fp:
             fp.write("AS      \tAS Name             \tGain    \tOwn     \tSum     \tRoutes  \n")
-            for asn in sorted(case_stat.keys(), key=lambda x: (sum(case_stat[x].values()), x), reverse=True):
-                if {d:v for d,v in case_stat[asn].items() if v > 0}:  # Just print it if there is at least one route
+            for row in sorted(range(len(asns)), key=lambda x: (totals[x], asns[x]), reverse=True):
+                if routes[row]:  # Just print it if there is at least one route
+                    asn = asns[row]
                     fp.write("%-8s\t%-20s\t%-8f\t%-8f\t%-8f\t%-8d\t%s\n" % (asn,
-                                                                            ip2as.get_as_name(asn)[:20],
-                                                                            sum(case_stat[asn].values()) - as_statistic[p].get(asn, 0),
+                                                                            as_names[asn][:20],
+                                                                            totals[row] - as_statistic[p].get(asn, 0),
                                                                             as_statistic[p].get(asn, 0),
-                                                                            sum(case_stat[asn].values()),
-                                                                            len({d:v for d,v in case_stat[asn].items() if v > 0}),  # Just remove the 0 values
-                                                                            {d:"%8f"%v for d,v in case_stat[asn].items() if v > 0}))  # Just remove the 0 values
+                                                                            totals[row],
+                                                                            routes[row],
+                                                                            route_probabilities[row]))
 
 
 def write_latex_table(run_name, case, as_statistic, multiple_case_stat):
@@ -231,21 +256,26 @@ def write_latex_table(run_name, case, as_statistic, multiple_case_stat):
     else:
         raise KeyError
 
-    for target, case_stat in multiple_case_stat.items():
+    for target in multiple_case_stat.target_asns():
 
-        fn = BASE_DIR + "/" + run_name + "/stat/" + case + "_" + target + "_latex_table.tex"
+        fn = BASE_DIR + "/" + run_name + "/stat/" + case + "_" + case_statistic.target_name(target) + "_latex_table.tex"
         logging.debug("Write %s statistic to %s" % (case, fn))
 
+        _, asns, totals, routes, _ = multiple_case_stat.select(target).rows()
+        asns = ["AS%d" % asn for asn in asns]
+        as_names = dict(zip(asns, ip2as.get_as_names(asns)))
+
         with open(fn, "w") as fp:
             fp.write(" AS      & AS Name             & Direction  &Probability    & Prob. Relays     & Prob. Routes     & Number Routes  \\\\ \n")
-            for asn in sorted(case_stat.keys(), key=lambda x: (sum(case_stat[x].values()), x), reverse=True):
-                if {d:v for d,v in case_stat[asn].items() if v > 0}:  # Just print it if there is at least one route
-                    prob = sum(case_stat[asn].values())
+            for row in sorted(range(len(asns)), key=lambda x: (totals[x], asns[x]), reverse=True):
+                if routes[row]:  # Just print it if there is at least one route
+                    asn = asns[row]
+                    prob = totals[row]
                     gain = prob - as_statistic[p].get(asn, 0)
-                    nr_routes = len({d:v for d,v in case_stat[asn].items() if v > 0})
+                    nr_routes = routes[row]
                     if prob > 0.025 or gain > 0.01 or nr_routes > 5:
                         fp.write("%-8s  & " % asn)
-                        fp.write("%-10s  & " % ip2as.get_as_name(asn)[:10])
+                        fp.write("%-10s  & " % as_names[asn][:10])
                         fp.write("%-6s  & " % p)
                         fp.write("%-.3f  & " % prob if prob > 0 else "-         & ")
                         fp.write("%-.3f  & " % as_statistic[p].get(asn, 0) if as_statistic[p].get(asn, 0) > 0 else "-         & " )
@@ -267,11 +297,10 @@ def write_data_for_guard_top(run_name, case, as_statistic, multiple_case_stat):
 
         final_stat = []  #   AS:  [prob value, prob value ... from different origins]
 
-        for target, case_stat in multiple_case_stat.items():
-            for asn in sorted(case_stat.keys(), key=lambda x: (sum(case_stat[x].values()), x), reverse=True):
-                if {d:v for d,v in case_stat[asn].items() if v > 0}:  # Just print it if there is at least one route
-                    prob = sum(case_stat[asn].values())
-                    final_stat.append((asn, prob))
+        _, asns, totals, routes, _ = multiple_case_stat.rows()
+        for asn, prob, nr_routes in zip(asns, totals, routes):
+            if nr_routes:  # Just print it if there is at least one route
+                final_stat.append(("AS%d" % asn, prob))
 
         for a,p in sorted(final_stat):
            fp.write("%s %f\n" % (a, p))
@@ -279,6 +308,9 @@ def write_data_for_guard_top(run_name, case, as_statistic, multiple_case_stat):
 
 def write_double_latex_table( run_name, as_statistic, name, entry_stat, exit_stat):
 
+    # AS -> (probability, number of routes with a probability above 0)
+    entry_stat = {"AS%d" % asn: (prob, nr_routes) for _, asn, prob, nr_routes in zip(*entry_stat.rows()[:4])}
+    exit_stat = {"AS%d" % asn: (prob, nr_routes) for _, asn, prob, nr_routes in zip(*exit_stat.rows()[:4])}
     all_asn = set(entry_stat.keys()) | set(exit_stat.keys())
 
     fn = BASE_DIR + "/" + run_name + "/stat/combined_" +  name +"latex_table.tex"
@@ -288,17 +320,16 @@ def write_double_latex_table( run_name, as_statistic, name, entry_stat, exit_sta
 
         finstat = []
 
-        for asn in sorted(set(entry_stat.keys()) | set(exit_stat.keys())):
+        sorted_asn = sorted(all_asn)
+        for asn, asname in zip(sorted_asn, ip2as.get_as_names(sorted_asn)):
 
             stat = dict()
 
             stat["asn"] = asn
-            stat["asname"] = ip2as.get_as_name(asn)[:10]
-            stat["g_prob"] = sum(entry_stat.get(asn,{}).values())
-            stat["e_prob"] = sum(exit_stat.get(asn,{}).values())
+            stat["asname"] = asname[:10]
+            stat["g_prob"], stat["nr_g_routes"] = entry_stat.get(asn, (0, 0))
+            stat["e_prob"], stat["nr_e_routes"] = exit_stat.get(asn, (0, 0))
             stat["comb"] = stat["g_prob"] * stat["e_prob"]
-            stat["nr_g_routes"] = len({d:v for d,v in entry_stat.get(asn,{}).items() if v > 0})
-            stat["nr_e_routes"] = len({d: v for d, v in exit_stat.get(asn,{}).items() if v > 0})
 
             finstat.append(stat)
 
@@ -312,96 +343,11 @@ def write_double_latex_table( run_name, as_statistic, name, entry_stat, exit_sta
             fp.write("%-.3f  \\\\ \n" % stat["comb"] if stat["comb"] > 0     else "-       \\\\ \n")
 
 
-
-def get_asn_set_from_traceroute(traceroute):
+def analyze_measurement(measurement, ipv6=False, jobs=1, trace_results=False):
     """
-    Retrieves the ASN out of the traceroute result object
-
-    Args:
-        traceroute: traceroute result object from RIPE measurement
-
-    Returns: Set of ASN
+    Analyze one full measurement which consists of 4 cases, the result files are read in jobs processes
 
-    """
-    logging.debug("Start getting ASN set from traceroute for measurement %s" % traceroute["msm_id"])
-
-    f_src = traceroute["from"]
-    logging.debug("From: %s" % f_src)
-
-    f_dst = traceroute["dst_addr"]
-    logging.debug("Dst: %s" % f_dst)
-
-    logging.debug("Number Hops: %d" % len(traceroute["result"]))
-
-    # If there is any error in the hops
-    timeouts = 0
-    for hop in traceroute["result"]:
-        if "error" in hop:
-            logging.debug("Errors in Hop %s" % str(hop))
-        else:
-            # else, check if there are timeouts in the trace
-            hop_results = hop.get('result')
-            if hop_results is not None and len(hop_results) > 0 and 'x' in hop_results[0]:
-                timeouts += 1
-
-    if timeouts > 0:
-        logging.debug(f'Found {timeouts}')
-
-    # Check how many result sections are in each hop if hop is non None (error)
-    len_list = [len(hop.get("result")) for hop in traceroute["result"] if hop.get('result') is not None]
-    len_set = set(len_list)
-    # There are only simple result sections with one IP each
-    if len(len_set) == 0:
-        logging.warning(f'Found 0 hops for {traceroute["msm_id"]}, possible error!')
-        f_hops = []
-    elif len_set == {1}:
-        f_hops = [hop["result"][0]["from"] for hop in traceroute["result"] if "from" in hop["result"][0]]
-        logging.debug("Simple Traceroute, only %d hops with 1 result each and %d IPs: %s" % (len(traceroute["result"]), len(f_hops), f_hops))
-
-    else:
-        logging.debug("Complex Traceroute: Results are %s", str(len_list))
-
-        f_hops = []
-        # a 0 Approach - erstes Element im Array -> Scheisse
-        # b All Approach - schauen wie sich das auswirkt
-        # c Late verwerfen - dup verwerfen - icmpext verwerfen
-        # d Schaun was stimmt?
-
-        complex_logger = logging.getLogger("complex")
-        complex_logger.info("Measurement %s" % traceroute["msm_id"])
-
-        for idx, hop in enumerate(traceroute["result"]):
-            if len(hop["result"]) == 1 and "from" in hop["result"][0]:
-                f_hops.append(hop["result"][0]["from"])
-            elif len(hop["result"]) > 1:
-                complex_logger.info("hop %d has %d results: %s" % (idx, len(hop["result"]), hop))
-
-                # If they are all the same, add it
-                hop_r_set = {x["from"] for x in hop["result"] if "from" in x}
-                if len(hop_r_set) == 1:
-                    complex_logger.info("All Froms are the same, easy ... add %s" % hop["result"][0]["from"])
-                    f_hops.append(hop["result"][0]["from"])
-                else:
-                    complex_logger.warning("Dont know what to do, add all IPs")
-                    f_hops.extend([x["from"] for x in hop["result"] if "from" in x])
-
-    # Add Source and Destination to List of IPs
-    ips = [f_src, *f_hops, f_dst]
-    return ips
-
-
-def translate_ips_to_asn(ips):
-    # Add a set of all ASN for that list of IPs
-    # Private IP Ranges should be AS0, so discard it afterwards
-    as_list = [ip2as.ip2asn(ip) for ip in ips]
-    logging.debug("Found %s for traceroute" % str(as_list))
-
-    return as_list
-
-
-def analyze_measurement(measurement, ipv6=False):
-    """
-    Analyze one full measurement which consists of 4 cases
+    With trace_results the diagnostics of every route are written to stat/trace.jsonl.
     """
 
     # CREATE STAT DIR
@@ -412,25 +358,19 @@ def analyze_measurement(measurement, ipv6=False):
 
 
     # Add loggers for various aspects
-    ass_logger = logging.getLogger("as_set")
-    file_handler = logging.FileHandler(stat_dir + "/as_set.log", mode='w')
-    file_handler.setFormatter(logging.Formatter("%(levelname)-8s %(message)s"))
-    ass_logger.addHandler(file_handler)
-
     basic_logger = logging.getLogger("basic_logger")
     file_handler = logging.FileHandler(stat_dir + "/basic_logger.log", mode='w')
     file_handler.setFormatter(logging.Formatter("%(levelname)-8s %(message)s"))
     basic_logger.addHandler(file_handler)
 
-    complex_logger = logging.getLogger("complex")
-    file_handler = logging.FileHandler(stat_dir + "/complex.log", mode='w')
-    file_handler.setFormatter(logging.Formatter("%(levelname)-8s %(message)s"))
-    complex_logger.addHandler(file_handler)
+    if trace_results:
+        tracing.open_trace(stat_dir + "/" + TRACE_FILENAME)
+        logging.info("Tracing routes to %s/%s" % (stat_dir, TRACE_FILENAME))
 
     # Load the datafiles
     logging.info("Load data files")
     ip2as.load(BASE_DIR + "/" + measurement + "/data/ip2asn-v4.tsv")
-    details = data.load_details(BASE_DIR + "/" + measurement + "/data/details.json")
+    details = data.load_details(BASE_DIR + "/" + measurement + "/data/details.json", data.RELAY_FIELDS)
     as_statistic = load_as_statistic(details, ipv6)
     logging.info("... loaded")
 
@@ -440,12 +380,22 @@ def analyze_measurement(measurement, ipv6=False):
 
     stats = {}
 
+    # the workers share the mapped ip2asn snapshots instead of loading their own copy
+    executor = None
+    if jobs > 1:
+        executor = ProcessPoolExecutor(jobs, initializer=ip2as.attach, initargs=(ip2as.lookup,))
+        logging.info("Read results in %d processes" % jobs)
+
     # Analyze these cases
     for case in cases:
-        stats[case] = analyze_case(as_statistic, measurement, case)
+        stats[case] = analyze_case(as_statistic, measurement, case, executor)
         # write_case_table(measurement, case, as_statistic, stats[case])
         write_case_stats(measurement, case, as_statistic, stats[case])
 
+    if executor is not None:
+        executor.shutdown()
+    tracing.close_trace()
+
 #    logging.info("Origins: %d %d  -  Destinations %d %d" %(len(stats["case1"]), len(stats["case4"]), len(stats["case2"]), len(stats["case3"])))
 
     if "case1" in cases and "case4" in cases:
@@ -461,65 +411,46 @@ def analyze_measurement(measurement, ipv6=False):
         write_case_stats(measurement, "exit", as_statistic, res_e)
         write_latex_table(measurement, "exit", as_statistic, res_e)
 
-    if len(stats["case1"]) == len(stats["case2"]) == len(stats["case3"]) == len(stats["case4"]) == 1:
+    if len(stats["case1"].target_asns()) == len(stats["case2"].target_asns()) == \
+            len(stats["case3"].target_asns()) == len(stats["case4"].target_asns()) == 1:
         # SINGLE SRC/DST TEST
-        client_as = list(stats["case1"].keys())[0] #case1 as == case4 as
-        destination_as = list(stats["case2"].keys())[0] #case2 as == case3 as
-        if res_e.get(destination_as) and res_g.get(client_as):
-            write_double_latex_table(measurement, as_statistic, f"{client_as}-{destination_as}", res_g.get(client_as), res_e.get(destination_as))
+        client_as = stats["case1"].target_asns()[0] #case1 as == case4 as
+        destination_as = stats["case2"].target_asns()[0] #case2 as == case3 as
+        if destination_as in res_e.target_asns() and client_as in res_g.target_asns():
+            write_double_latex_table(measurement, as_statistic, f"AS{client_as}-AS{destination_as}", res_g.select(client_as), res_e.select(destination_as))
     else:
         # MULTI SRC/DST TEST
-        for cas, cas_result in res_g.items():
-            write_double_latex_table(measurement, as_statistic, "E-MAXSUM-FROM-"+cas, cas_result, res_e.get("MAXAND"))
+        for cas in res_g.target_asns():
+            write_double_latex_table(measurement, as_statistic, "E-MAXSUM-FROM-" + case_statistic.target_name(cas),
+                                     res_g.select(cas), res_e.select(case_statistic.MAXAND))
+
+    # with a process pool the hops of the result files were resolved by the workers, their caches are not counted
+    scope = " (this process only, not the %d workers)" % jobs if jobs > 1 else ""
+    for name, cache_stat in ip2as.cache_stats().items():
+        lookups = cache_stat["hits"] + cache_stat["misses"]
+        logging.info("%s cache%s: %d hits, %d misses, %d evictions (hit rate %.1f%%)" %
+                     (name, scope, cache_stat["hits"], cache_stat["misses"], cache_stat["evictions"],
+                      100 * cache_stat["hits"] / lookups if lookups else 0))
 
 
 def combine_results(s1, s2):
-    if len(s1) == len(s2) == 0:
-        return {}
-    elif len(s1) == len(s2) == 1:
+    """
+    Combine the statistics of two cases (case1 and case4 or case2 and case3), the larger probability per cell
+
+    With several targets the MAXAND target is added, the largest probability of every cell over all targets.
+    """
+    targets1, targets2 = s1.target_asns(), s2.target_asns()
+    if len(targets1) == len(targets2) == 0:
+        return case_statistic.CaseStatistic()
+    elif len(targets1) == len(targets2) == 1:
         # SINGLE SRC/DST TEST
-        name1, s1 = next(iter(s1.items()))
-        name2, s2 = next(iter(s2.items()))
-        if name1 != name2:
+        if targets1 != targets2:
             raise KeyError
-
-        result_table = dict()
-
-        # For every row in either s1 or s2
-        for asn in sorted(s1.keys() | s2.keys(), key=lambda x: int(x[2:])):
-
-            s1v = s1.get(asn, {})
-            s2v = s2.get(asn, {})
-
-            result_table.setdefault(name1, dict())[asn] = {h: max(s1v.get(h, 0), s2v.get(h, 0)) for h in sorted(s1v.keys() | s2v.keys(), key=lambda x: int(x[2:]))}
-
-        return result_table
-
+        return s1.combine_max(s2)
     else:
         # MULTI SRC/DST TEST
-        key_set = set(s1.keys()) | set(s2.keys())
-
-        result_table = {"MAXAND": dict()}
-
-        for name in key_set:
-            ss1dict = s1.get(name, {})
-            ss2dict = s2.get(name, {})
-
-            for asn in sorted(ss1dict.keys() | ss2dict.keys(), key=lambda x: int(x[2:])):
-                s1v = ss1dict.get(asn, {})
-                s2v = ss2dict.get(asn, {})
-
-                result_table.setdefault(name, dict())[asn] = {h: max(s1v.get(h, 0), s2v.get(h, 0)) for h in
-                                                               sorted(s1v.keys() | s2v.keys(),
-                                                                      key=lambda x: int(x[2:]))}
-
-            for as_in_destination, gewichtungswerte in result_table[name].items():
-                for gewichtungs_as, gewichtung in gewichtungswerte.items():
-                    result_table["MAXAND"].setdefault(as_in_destination, dict())[gewichtungs_as] = gewichtung
-
         # TODO STILL ADD AN TOTAL OF ALL HERE ... HOW NOT KNOWN
-
-        return result_table
+        return s1.combine_max(s2).with_maxand()
 
 
 if __name__ == '__main__':
@@ -529,8 +460,16 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Evaluate a given RIPETor measurement')
     parser.add_argument('-i', '--input', required=True, type=str, help='Path to a given measurement')
     parser.add_argument('-6', '--ipv6', action="store_true", default=False, help="Use IPv6 Only mode")
+    parser.add_argument('-c', '--cache-size', type=int, default=ip2as.CACHE_SIZE,
+                        help="Entries kept by the ip2asn and AS name lookup caches (0 disables them)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Processes reading the result files into the hop store (default 1, no process pool)")
+    parser.add_argument('-t', '--trace', action="store_true", default=False,
+                        help="Write the ASes and probabilities of every route to stat/" + TRACE_FILENAME)
     args = parser.parse_args()
 
+    ip2as.set_cache_size(args.cache_size)
+
     basepath = args.input
     basepath = pathlib.Path(basepath)
     basepath = basepath.absolute()
@@ -548,4 +487,4 @@ if __name__ == '__main__':
 
     logging.info(f'Working with measurement {measurement} in basepath {BASE_DIR}')
 
-    analyze_measurement(measurement, ipv6_mode)
+    analyze_measurement(measurement, ipv6_mode, args.jobs, args.trace)
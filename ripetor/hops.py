@@ -0,0 +1,274 @@
+"""
+Columnar store of the traceroutes of a run
+
+Parsing the RIPE Atlas results and resolving every hop to its AS is most of the work of an evaluation, so
+it is done once per case and kept as numpy arrays in <run>/hop-store/<case>/:
+
+    results.<column>.npy  one row per traceroute: msm_id, prb_id, timestamp, src, dst, src_asn, dst_asn
+    hops.<column>.npy     one row per distinct reply address of a hop: result (row in results), hop, ip, asn
+
+Addresses are packed into 16 bytes (IPv4 as IPv4-mapped IPv6 address), ASNs are numbers with 0 for
+private, unknown and missing addresses. manifest.json lists the result files the store was built from,
+files that are new or changed (e.g. after more results were downloaded) are read again on the next use.
+"""
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import socket
+
+import numpy as np
+
+try:
+    from ripetor import ip2as, results
+except:
+    import ip2as
+    import results
+
+STORE_DIRNAME = "hop-store"
+MANIFEST_FILENAME = "manifest.json"
+# bump when the columns change, older stores are rebuilt
+STORE_VERSION = 2
+
+RESULT_COLUMNS = ("msm_id", "prb_id", "timestamp", "src", "dst", "src_asn", "dst_asn")
+HOP_COLUMNS = ("result", "hop", "ip", "asn")
+
+# result files handed to a worker at once when building with a process pool
+INGEST_CHUNK_SIZE = 16
+
+V4_MAPPED_PREFIX = bytes(10) + b"\xff\xff"
+
+
+def store_dir(run_path, case):
+    return pathlib.Path(run_path).joinpath(STORE_DIRNAME, case)
+
+
+def pack_ip(ip_string):
+    """16 byte form of an ip string, all zero if it is missing or invalid"""
+    if ip_string:
+        try:
+            return V4_MAPPED_PREFIX + socket.inet_pton(socket.AF_INET, ip_string)
+        except (OSError, ValueError):
+            pass
+        try:
+            return socket.inet_pton(socket.AF_INET6, ip_string)
+        except (OSError, ValueError):
+            pass
+    return bytes(16)
+
+
+def unpack_ip(packed):
+    """ip string of a packed address, "" for a missing one"""
+    # numpy drops trailing zero bytes of S16 items
+    packed = bytes(packed).ljust(16, b"\0")
+    if packed == bytes(16):
+        return ""
+    if packed.startswith(V4_MAPPED_PREFIX):
+        return socket.inet_ntop(socket.AF_INET, packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+def _ip_column(ip_strings):
+    return np.frombuffer(b"".join(pack_ip(ip_string) for ip_string in ip_strings), dtype="S16").copy()
+
+
+class HopStore:
+    """The result and hop columns of one case, as dicts column name -> numpy array"""
+
+    def __init__(self, result_columns, hop_columns):
+        self.results = result_columns
+        self.hops = hop_columns
+
+    def __len__(self):
+        return len(self.results["msm_id"])
+
+    @classmethod
+    def from_traceroutes(cls, traceroutes):
+        """Store of traceroute results (dicts as returned by RIPE Atlas), addresses resolved with ip2as"""
+        msm_ids, prb_ids, timestamps, srcs, dsts = [], [], [], [], []
+        hop_results, hop_numbers, hop_ips = [], [], []
+        for row, traceroute in enumerate(traceroutes):
+            msm_ids.append(traceroute.get("msm_id", 0))
+            prb_ids.append(traceroute.get("prb_id", 0))
+            timestamps.append(traceroute.get("timestamp", 0))
+            srcs.append(traceroute.get("from") or "")
+            dsts.append(traceroute.get("dst_addr") or "")
+            # hops with an error have no replies, replies that timed out have no address
+            for hop in traceroute.get("result") or ():
+                for ip_string in dict.fromkeys(reply["from"] for reply in hop.get("result") or () if "from" in reply):
+                    hop_results.append(row)
+                    hop_numbers.append(hop.get("hop", 0))
+                    hop_ips.append(ip_string)
+
+        unique = list(dict.fromkeys(srcs + dsts + hop_ips))
+        asns = dict(zip(unique, (ip2as.asn_to_int(asn) for asn in ip2as.ip2asn_many(unique))))
+
+        return cls(
+            {
+                "msm_id": np.array(msm_ids, dtype=np.int64),
+                "prb_id": np.array(prb_ids, dtype=np.int64),
+                "timestamp": np.array(timestamps, dtype=np.int64),
+                "src": _ip_column(srcs),
+                "dst": _ip_column(dsts),
+                "src_asn": np.array([asns[ip_string] for ip_string in srcs], dtype=np.int64),
+                "dst_asn": np.array([asns[ip_string] for ip_string in dsts], dtype=np.int64),
+            },
+            {
+                "result": np.array(hop_results, dtype=np.int64),
+                "hop": np.array(hop_numbers, dtype=np.int32),
+                "ip": _ip_column(hop_ips),
+                "asn": np.array([asns[ip_string] for ip_string in hop_ips], dtype=np.int64),
+            },
+        )
+
+    @classmethod
+    def concatenate(cls, stores):
+        """One store of several, the hops of each keep pointing to their results"""
+        stores = list(stores)
+        if not stores:
+            return cls.from_traceroutes([])
+        offsets = np.cumsum([0] + [len(store) for store in stores[:-1]])
+        result_columns = {name: np.concatenate([store.results[name] for store in stores]) for name in RESULT_COLUMNS}
+        hop_columns = {name: np.concatenate([store.hops[name] for store in stores]) for name in HOP_COLUMNS}
+        hop_columns["result"] = np.concatenate([store.hops["result"] + offset
+                                                for store, offset in zip(stores, offsets)])
+        return cls(result_columns, hop_columns)
+
+    def rows(self, start, stop):
+        """Store of the results start:stop and their hops"""
+        hop_start, hop_stop = np.searchsorted(self.hops["result"], [start, stop]).tolist()
+        hop_columns = {name: self.hops[name][hop_start:hop_stop] for name in HOP_COLUMNS}
+        hop_columns["result"] = hop_columns["result"] - start
+        return HopStore({name: self.results[name][start:stop] for name in RESULT_COLUMNS}, hop_columns)
+
+    def save(self, directory):
+        directory = pathlib.Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for prefix, columns in (("results", self.results), ("hops", self.hops)):
+            for name, column in columns.items():
+                # replace the file instead of writing into it, a store loaded from it keeps its mapping
+                fn = directory.joinpath(f"{prefix}.{name}.npy")
+                with open(fn.with_suffix(".tmp"), "wb") as fp:
+                    np.save(fp, column)
+                os.replace(fn.with_suffix(".tmp"), fn)
+
+    @classmethod
+    def load(cls, directory):
+        """Map the columns of a saved store"""
+        directory = pathlib.Path(directory)
+        return cls({name: np.load(directory.joinpath(f"results.{name}.npy"), mmap_mode="r") for name in RESULT_COLUMNS},
+                   {name: np.load(directory.joinpath(f"hops.{name}.npy"), mmap_mode="r") for name in HOP_COLUMNS})
+
+
+def read_result_file(filename):
+    return HopStore.from_traceroutes(results.iter_results(filename))
+
+
+def result_files(results_dir):
+    """Result files of a case directory by name, the .jsonl file of a measurement that also has a legacy .json"""
+    files = {}
+    for path in sorted(pathlib.Path(results_dir).iterdir()):
+        if path.suffix not in (results.SUFFIX, results.LEGACY_SUFFIX):
+            continue
+        m_id = results.measurement_id(path)
+        if m_id not in files or path.suffix == results.SUFFIX:
+            files[m_id] = path
+    return list(files.values())
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_entries(files, known):
+    """name -> {size, mtime_ns, sha256} of files, only those not in known with the same size and mtime are hashed"""
+    entries = {}
+    for path in files:
+        stat = os.stat(path)
+        entry = known.get(path.name)
+        if entry is None or (entry["size"], entry["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_digest(path)}
+        entries[path.name] = {"size": entry["size"], "mtime_ns": entry["mtime_ns"], "sha256": entry["sha256"]}
+    return entries
+
+
+def _load_manifest(directory):
+    try:
+        with open(pathlib.Path(directory).joinpath(MANIFEST_FILENAME)) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def _save(directory, manifest, store=None):
+    """Write the manifest and before it the columns of store, if given"""
+    manifest_fn = pathlib.Path(directory).joinpath(MANIFEST_FILENAME)
+    try:
+        if store is not None:
+            # the manifest is written last, a store without one gets rebuilt
+            manifest_fn.unlink(missing_ok=True)
+            store.save(directory)
+        with open(manifest_fn.with_suffix(".tmp"), "w") as fp:
+            json.dump(manifest, fp)
+        os.replace(manifest_fn.with_suffix(".tmp"), manifest_fn)
+    except OSError as e:
+        logging.warning(f"Could not save the hop store to {directory}: {e}")
+
+
+def ensure_case(results_dir, directory, executor=None):
+    """
+    Store of the result files in results_dir, loaded from directory and brought up to date
+
+    The manifest keeps the sha256 and the rows of every file the store was built from, together with the
+    fingerprint of the ip2as data the addresses were resolved with. Only new and changed files are read
+    again, the rows of the others are taken over. Everything is read again if the ip2as data changed.
+    With an executor (a process pool whose workers attached the ip2as data, see ip2as.attach) the files are
+    read by its workers.
+    """
+    files = result_files(results_dir)
+    fingerprint = ip2as.fingerprint()
+
+    previous = _load_manifest(directory)
+    if not previous or previous.get("version") != STORE_VERSION or previous.get("ip2asn") != fingerprint:
+        previous = {"files": {}}
+    entries = _file_entries(files, previous["files"])
+
+    # rows of the stored files by content
+    stored_rows = {entry["sha256"]: entry["rows"] for entry in previous["files"].values()}
+    if previous["files"] and [(name, entry["sha256"]) for name, entry in entries.items()] == \
+            [(name, entry["sha256"]) for name, entry in previous["files"].items()]:
+        store = HopStore.load(directory)
+        if any((entries[name]["size"], entries[name]["mtime_ns"]) != (entry["size"], entry["mtime_ns"])
+               for name, entry in previous["files"].items()):
+            # same content, only remember the new mtimes so the files are not hashed again
+            for name, entry in entries.items():
+                entry["rows"] = previous["files"][name]["rows"]
+            _save(directory, {"version": STORE_VERSION, "ip2asn": fingerprint, "files": entries})
+        return store
+
+    stored = HopStore.load(directory) if stored_rows else None
+    changed = [path for path in files if entries[path.name]["sha256"] not in stored_rows]
+    logging.info(f"Updating hop store of {results_dir}: reading {len(changed)} of {len(files)} result files")
+    if executor is None:
+        read = map(read_result_file, changed)
+    else:
+        read = executor.map(read_result_file, changed, chunksize=INGEST_CHUNK_SIZE)
+
+    parts = []
+    row = 0
+    for path in files:
+        entry = entries[path.name]
+        part = stored.rows(*stored_rows[entry["sha256"]]) if entry["sha256"] in stored_rows else next(read)
+        entry["rows"] = [row, row + len(part)]
+        row += len(part)
+        parts.append(part)
+    store = HopStore.concatenate(parts)
+    logging.info(f"... {len(store)} traceroutes with {len(store.hops['result'])} hops")
+
+    _save(directory, {"version": STORE_VERSION, "ip2asn": fingerprint, "files": entries}, store)
+    return store
@@ -1,75 +1,504 @@
+import hashlib
+import ipaddress
+import logging
+import mmap
+import os
+import socket
+import struct
+import tempfile
+from collections import OrderedDict
+from ipaddress import ip_address, ip_network
 
-from ipaddress import ip_address
-from ip2asn import IP2ASN
+import numpy as np
 
 
-ip2a_v4 = None
-ip2a_v6 = None
+# compiled binary snapshot written next to each ip2asn tsv file
+SNAPSHOT_SUFFIX = ".bin"
+SNAPSHOT_MAGIC = b"IP2ASNB1"
+# magic, ip version, number of ranges, number of strings, string blob size, tsv size, tsv mtime
+SNAPSHOT_HEADER = struct.Struct("<8sQQQQQq")
 
+# default number of entries kept by each lookup cache, 0 disables caching
+CACHE_SIZE = 65536
 
-def load(fn):
-    global ip2a_v4
-    global ip2a_v6
+# replace CIA TRIAD SECURITY LLC with ZWIEBELFREUNDE because ip2asn does not report it correctly
+ASN_OVERRIDES = {208294: 60729}
 
-    if not ip2a_v4:
-        ip2a_v4 = IP2ASN(fn, ipversion=4)
-    if 'ip2asn-v4' in fn and not ip2a_v6:
-        fn = fn.replace("ip2asn-v4", "ip2asn-v6")
-        ip2a_v6 = IP2ASN(fn, ipversion=6)
+# properties of an AS that get_as_property knows
+AS_PROPERTIES = ("owner", "country")
+
+
+def _to_keys(packed_addrs, version):
+    """
+    Convert packed addresses into a sortable numpy array
+
+    IPv4 addresses become uint32, IPv6 addresses do not fit into any numpy integer type and are kept
+    as 16 byte big endian strings, which sort in the same order as the numbers they represent.
+    """
+    if version == 4:
+        return np.frombuffer(b"".join(packed_addrs), dtype=">u4").astype(np.uint32)
+    return np.array(packed_addrs, dtype="S16")
+
+
+def _padded(size):
+    return (size + 7) & ~7
+
+
+class StringTable:
+    """Owner and country strings of a range table, stored as one utf-8 blob plus offsets"""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype="<u8")
+        offsets[1:] = np.cumsum([len(e) for e in encoded], dtype="<u8")
+        return cls(offsets, b"".join(encoded))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return bytes(self.blob[self.offsets[idx]:self.offsets[idx + 1]]).decode("utf-8")
+
+
+class RangeTable:
+    """Sorted, non overlapping ip ranges of one ip2asn file held in numpy arrays"""
+
+    def __init__(self, version, starts, ends, asns, owners=None, countries=None, strings=None, path=None):
+        self.version = version
+        self.starts = starts
+        self.ends = ends
+        self.asns = asns
+        # per range index into strings
+        self.owners = owners
+        self.countries = countries
+        self.strings = strings
+        # snapshot the arrays are mapped from, None for tables held in memory
+        self.path = path
+
+    def __reduce__(self):
+        # unpickling a mapped table maps the same snapshot again instead of copying the arrays
+        if self.path is not None:
+            return RangeTable.from_snapshot, (self.path,)
+        return RangeTable, (self.version, self.starts, self.ends, self.asns, self.owners, self.countries,
+                            self.strings)
+
+    @classmethod
+    def from_tsv(cls, fn, version):
+        family = socket.AF_INET if version == 4 else socket.AF_INET6
+        starts, ends, asns, owners, countries = [], [], [], [], []
+        string_ids = {}
+        with open(fn, "r") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t", 4)
+                if len(fields) < 5:
+                    continue
+                starts.append(socket.inet_pton(family, fields[0]))
+                ends.append(socket.inet_pton(family, fields[1]))
+                asns.append(int(fields[2]))
+                countries.append(string_ids.setdefault(fields[3], len(string_ids)))
+                owners.append(string_ids.setdefault(fields[4], len(string_ids)))
+
+        starts = _to_keys(starts, version)
+        order = np.argsort(starts, kind="stable")
+        return cls(version, starts[order], _to_keys(ends, version)[order],
+                   np.array(asns, dtype=np.uint32)[order],
+                   np.array(owners, dtype=np.uint32)[order],
+                   np.array(countries, dtype=np.uint32)[order],
+                   StringTable.from_strings(string_ids))
+
+    @classmethod
+    def from_snapshot(cls, fn):
+        """Memory map a snapshot written by save, the arrays are read only views on the mapped file"""
+        with open(fn, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, n_ranges, n_strings, blob_size, _, _ = SNAPSHOT_HEADER.unpack_from(mm, 0)
+            if magic != SNAPSHOT_MAGIC or version not in (4, 6):
+                raise ValueError(f"{fn} is no ip2asn snapshot")
+            key_dtype = "<u4" if version == 4 else "S16"
+            layout = ((key_dtype, n_ranges), (key_dtype, n_ranges), ("<u4", n_ranges),
+                      ("<u4", n_ranges), ("<u4", n_ranges), ("<u8", n_strings + 1))
+            size = SNAPSHOT_HEADER.size + sum(_padded(np.dtype(dtype).itemsize * count) for dtype, count in layout)
+            if size + blob_size > len(mm):
+                raise ValueError(f"{fn} is truncated")
+        except (ValueError, struct.error):
+            # nothing refers to the mapping yet, so it can be closed
+            mm.close()
+            raise
+
+        offset = SNAPSHOT_HEADER.size
+        arrays = []
+        for dtype, count in layout:
+            array = np.frombuffer(mm, dtype=dtype, count=count, offset=offset)
+            arrays.append(array)
+            offset += _padded(array.nbytes)
+        starts, ends, asns, owners, countries, string_offsets = arrays
+        blob = memoryview(mm)[offset:offset + blob_size]
+
+        return cls(version, starts, ends, asns, owners, countries, StringTable(string_offsets, blob), fn)
+
+    @classmethod
+    def from_networks(cls, networks, version):
+        """Build a table from a list of networks, overlapping networks are merged"""
+        ranges = []
+        for network in sorted((ip_network(n) for n in networks if ip_network(n).version == version),
+                              key=lambda n: n.network_address):
+            start, end = network.network_address, network.broadcast_address
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([start, end])
+
+        return cls(version,
+                   _to_keys([s.packed for s, e in ranges], version),
+                   _to_keys([e.packed for s, e in ranges], version),
+                   np.ones(len(ranges), dtype=np.uint32))
+
+    def save(self, fn, source_stat):
+        """Write the table as binary snapshot, tagged with size and mtime of the tsv it was built from"""
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.version, len(self.starts), len(self.strings),
+                                      len(self.strings.blob), source_stat.st_size, source_stat.st_mtime_ns)
+        key_dtype = "<u4" if self.version == 4 else "S16"
+
+        # write to a temporary file and rename it, so concurrent readers never see a partial snapshot
+        fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fn)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                for array, dtype in ((self.starts, key_dtype), (self.ends, key_dtype), (self.asns, "<u4"),
+                                     (self.owners, "<u4"), (self.countries, "<u4"),
+                                     (self.strings.offsets, "<u8")):
+                    data = np.ascontiguousarray(array, dtype=dtype).tobytes()
+                    f.write(data)
+                    f.write(b"\0" * (_padded(len(data)) - len(data)))
+                f.write(self.strings.blob)
+            os.chmod(tmp_fn, 0o644)
+            os.replace(tmp_fn, fn)
+        except BaseException:
+            os.unlink(tmp_fn)
+            raise
 
-def _ip2asn(ip_string):
-    if not ip2a_v4 and ip2a_v6:
-        raise LookupError("No data loaded")
+    def fingerprint(self):
+        """sha256 of the ranges and their ASNs"""
+        digest = hashlib.sha256(b"%d" % self.version)
+        for array in (self.starts, self.ends, self.asns):
+            digest.update(np.ascontiguousarray(array).data)
+        return digest.hexdigest()
+
+    def lookup(self, keys):
+        """Return the ASN of the range containing each key, 0 if no range contains it"""
+        if len(self.starts) == 0:
+            return np.zeros(len(keys), dtype=np.uint32)
+
+        idx = np.searchsorted(self.starts, keys, side="right") - 1
+        found = idx >= 0
+        idx[~found] = 0
+        found &= keys <= self.ends[idx]
+        return np.where(found, self.asns[idx], 0).astype(np.uint32)
+
+    def as_index(self):
+        """Map every ASN of the table to the row of its first range"""
+        asns, first = np.unique(self.asns, return_index=True)
+        return dict(zip(asns.tolist(), first.tolist()))
+
+    def row_property(self, row, attr):
+        column = {"owner": self.owners, "country": self.countries}[attr]
+        return self.strings[column[row]]
+
+
+def _snapshot_is_current(snapshot_fn, fn):
+    try:
+        with open(snapshot_fn, "rb") as f:
+            magic, _, _, _, _, size, mtime_ns = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+    except (OSError, struct.error):
+        return False
+    if magic != SNAPSHOT_MAGIC:
+        return False
+    if not os.path.isfile(fn):
+        # the tsv is gone, the snapshot is all we have
+        return True
+    stat = os.stat(fn)
+    return stat.st_size == size and stat.st_mtime_ns == mtime_ns
+
+
+def compile_snapshot(fn, version):
+    """Parse an ip2asn tsv file and write its binary snapshot next to it, returns the parsed table"""
+    logging.info("Compiling ip2asn snapshot for %s" % fn)
+    table = RangeTable.from_tsv(fn, version)
+    try:
+        table.save(fn + SNAPSHOT_SUFFIX, os.stat(fn))
+    except OSError as e:
+        logging.warning("Could not write ip2asn snapshot for %s: %s" % (fn, e))
+    return table
+
+
+def ensure_snapshot(fn, version):
+    """
+    Compile the snapshot of an ip2asn tsv file unless there is a current one already
+
+    Returns whether there is a current snapshot now, it is missing if it could not be written.
+    """
+    if not _snapshot_is_current(fn + SNAPSHOT_SUFFIX, fn):
+        compile_snapshot(fn, version)
+        return _snapshot_is_current(fn + SNAPSHOT_SUFFIX, fn)
+    return True
+
+
+def load_table(fn, version):
+    """Load the range table of an ip2asn tsv file, through its snapshot if there is a current one"""
+    snapshot_fn = fn + SNAPSHOT_SUFFIX
+    if not _snapshot_is_current(snapshot_fn, fn):
+        table = compile_snapshot(fn, version)
+        if not os.path.isfile(snapshot_fn):
+            return table
+    return RangeTable.from_snapshot(snapshot_fn)
+
+
+def private_networks(version):
+    """
+    Networks whose addresses ipaddress reports as is_private, private addresses resolve to AS0
+
+    ipaddress keeps them in its (undocumented) constants, newer Python versions also list exceptions
+    inside of them, which are left out here as well.
+    """
+    constants = (ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address)._constants
+    networks = list(constants._private_networks)
+    for exception in getattr(constants, "_private_networks_exceptions", ()):
+        networks = [part for network in networks
+                    for part in (network.address_exclude(exception) if exception.subnet_of(network) else [network])]
+    return networks
+
+
+private_v4 = RangeTable.from_networks(private_networks(4), 4)
+private_v6 = RangeTable.from_networks(private_networks(6), 6)
+
+
+def _pack_address(ip_string):
+    """Return the packed form of an ip string (4 or 16 bytes) or None if it is no valid address"""
     try:
-        ip = ip_address(ip_string)
-        if ip.is_private:
-            raise ValueError("IP addr is private")
-        # per default we use ipv4
-        ip2a = ip2a_v4
-        # switch to ipv6 when ip str is in ipv6 format
-        if ip.version == 6:
-            ip2a = ip2a_v6
-        result = ip2a.lookup_address(ip_string)
-        number = result.get('ASN', 0)
-        return f"AS{number}"
-    except:
+        return socket.inet_pton(socket.AF_INET, ip_string)
+    except (OSError, TypeError, ValueError):
         pass
-    return "AS0"
+    try:
+        return ip_address(ip_string).packed
+    except ValueError:
+        return None
 
-def ip2asn(ip_string):
-    asn = _ip2asn(ip_string)
-    asn = asn.replace("AS208294", "AS60729") # replace CIA TRIAD SECURITY LLC with ZWIEBELFREUNDE because ip2asn does not report it correctly
-    return asn
 
 def asn_to_int(asn):
     if isinstance(asn, str):
         number_str = asn.strip("AS")
         asn = int(number_str)
     return asn
-    
-def get_as_property(asn, attr):
-    if not ip2a_v4 and ip2a_v6:
-        raise LookupError("No data loaded")
 
-    asn = asn_to_int(asn)
-    
-    # try v4
-    try:
-        result = ip2a_v4.lookup_asn(asn, limit=1)
-        return result[0][attr]
-    except:
-        pass
-    # fallback v6
-    try:
-        result = ip2a_v6.lookup_asn(asn, limit=1)
-        return result[0][attr]
-    except:
-        pass
-    # else return nothing
-    return ""
+
+class IP2ASLookup:
+    """
+    ip and ASN lookups over the v4 and v6 range tables
+
+    Pickling only transfers the snapshot paths of mapped tables, so a lookup handed to process pool
+    workers (e.g. through attach as initializer) maps the same files and shares their pages.
+    """
+
+    def __init__(self, ranges_v4=None, ranges_v6=None):
+        self.ranges_v4 = ranges_v4
+        self.ranges_v6 = ranges_v6
+
+        self._fingerprint = None
+
+        # ASN -> (range table, row of its first range), merged from both tables with v4 taking precedence
+        self.as_index = {}
+        for ranges in (ranges_v4, ranges_v6):
+            if ranges is not None:
+                for asn, row in ranges.as_index().items():
+                    self.as_index.setdefault(asn, (ranges, row))
+
+    def __getstate__(self):
+        return self.ranges_v4, self.ranges_v6
+
+    def fingerprint(self):
+        """Hash of everything ip2asn_many depends on, it resolves the same as long as this does not change"""
+        if self._fingerprint is None:
+            parts = [ranges.fingerprint() if ranges is not None else "" for ranges in (self.ranges_v4, self.ranges_v6)]
+            parts += [private_v4.fingerprint(), private_v6.fingerprint(), repr(sorted(ASN_OVERRIDES.items()))]
+            self._fingerprint = hashlib.sha256("\n".join(parts).encode()).hexdigest()
+        return self._fingerprint
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def ip2asn_many(self, ip_strings):
+        """
+        Resolve a batch of ip strings to "AS<number>" strings, in the same order
+
+        Every address family is resolved with a single searchsorted over the range table.
+        Private, invalid and unknown addresses resolve to AS0.
+        """
+        if not self.ranges_v4 and self.ranges_v6:
+            raise LookupError("No data loaded")
+
+        ip_strings = list(ip_strings)
+        unique = list(dict.fromkeys(ip_strings))
+        asn_strings = ["AS0"] * len(unique)
+
+        packed = {4: [], 6: []}
+        positions = {4: [], 6: []}
+        for pos, ip_string in enumerate(unique):
+            packed_addr = _pack_address(ip_string)
+            if packed_addr is None:
+                continue
+            version = 4 if len(packed_addr) == 4 else 6
+            packed[version].append(packed_addr)
+            positions[version].append(pos)
+
+        for version, ranges, private in ((4, self.ranges_v4, private_v4), (6, self.ranges_v6, private_v6)):
+            if not packed[version] or ranges is None:
+                continue
+            keys = _to_keys(packed[version], version)
+            asns = ranges.lookup(keys)
+            asns[private.lookup(keys) != 0] = 0
+            for pos, number in zip(positions[version], asns.tolist()):
+                asn_strings[pos] = f"AS{ASN_OVERRIDES.get(number, number)}"
+
+        resolved = dict(zip(unique, asn_strings))
+        return [resolved[ip_string] for ip_string in ip_strings]
+
+    def get_as_property(self, asn, attr):
+        if attr not in AS_PROPERTIES:
+            raise KeyError(f"Unknown AS property {attr}, known are {', '.join(AS_PROPERTIES)}")
+        if not self.ranges_v4 and self.ranges_v6:
+            raise LookupError("No data loaded")
+
+        entry = self.as_index.get(asn_to_int(asn))
+        if entry is None:
+            # else return nothing
+            return ""
+        ranges, row = entry
+        return ranges.row_property(row, attr)
+
+
+class LRUCache:
+    """Bounded least recently used cache that counts hits, misses and evictions"""
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached value or None"""
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self.entries)}
+
+
+lookup = IP2ASLookup()
+ip_cache = LRUCache()
+as_cache = LRUCache()
+
+
+def set_cache_size(maxsize):
+    """Change the size of both lookup caches, 0 disables them"""
+    global ip_cache
+    global as_cache
+    ip_cache = LRUCache(maxsize)
+    as_cache = LRUCache(maxsize)
+
+
+def cache_stats():
+    return {"ip2asn": ip_cache.stats(), "as_property": as_cache.stats()}
+
+
+def load(fn):
+    global lookup
+
+    ranges_v4 = lookup.ranges_v4
+    ranges_v6 = lookup.ranges_v6
+    if not ranges_v4:
+        ranges_v4 = load_table(fn, 4)
+    if 'ip2asn-v4' in fn and not ranges_v6:
+        fn = fn.replace("ip2asn-v4", "ip2asn-v6")
+        ranges_v6 = load_table(fn, 6)
+    lookup = IP2ASLookup(ranges_v4, ranges_v6)
+    ip_cache.clear()
+    as_cache.clear()
+
+
+def attach(shared_lookup):
+    """Use a lookup loaded by another process, e.g. Pool(initializer=ip2as.attach, initargs=(ip2as.lookup,))"""
+    global lookup
+    lookup = shared_lookup
+    ip_cache.clear()
+    as_cache.clear()
+
+
+def fingerprint():
+    """Fingerprint of the loaded data, e.g. to tell whether ASNs resolved before are still valid"""
+    return lookup.fingerprint()
+
+
+def ip2asn_many(ip_strings):
+    ip_strings = list(ip_strings)
+
+    resolved = {}
+    missing = []
+    for ip_string in dict.fromkeys(ip_strings):
+        asn = ip_cache.get(ip_string)
+        if asn is None:
+            missing.append(ip_string)
+        else:
+            resolved[ip_string] = asn
+
+    for ip_string, asn in zip(missing, lookup.ip2asn_many(missing)):
+        ip_cache.put(ip_string, asn)
+        resolved[ip_string] = asn
+
+    return [resolved[ip_string] for ip_string in ip_strings]
+
+
+def ip2asn(ip_string):
+    return ip2asn_many([ip_string])[0]
+
+def get_as_property(asn, attr):
+    key = (asn_to_int(asn), attr)
+    value = as_cache.get(key)
+    if value is None:
+        value = lookup.get_as_property(asn, attr)
+        as_cache.put(key, value)
+    return value
 
 def get_as_name(asn):
     return get_as_property(asn, 'owner')
 
+def get_as_names(asns):
+    return [get_as_name(asn) for asn in asns]
+
 def get_as_country(asn):
     return get_as_property(asn, 'country')
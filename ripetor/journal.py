@@ -0,0 +1,85 @@
+"""
+Journal of a measurement campaign, so an interrupted run can be resumed
+
+Every change of the campaign state is appended as one JSON line to <run>/campaign.jsonl and synced to
+disk before the run goes on:
+
+    {"event": "starting", "case": "case1", "part": 0}                  request about to be sent
+    {"event": "started", "case": "case1", "part": 0, "measurements": [...]}
+    {"event": "downloaded", "case": "case1", "id": 1234}                result complete, stop sent
+    {"event": "finished", "id": 1234}                                   RIPE Atlas reports it stopped
+    {"event": "ended", "case": "case1", "id": 1234}                     ended on its own, results downloaded
+
+replay rebuilds the measurement_responses of atlas.MeasurementScheduler from it.
+"""
+import json
+import logging
+import os
+import pathlib
+
+JOURNAL_FILENAME = "campaign.jsonl"
+
+
+def journal_filename(base_path):
+    return pathlib.Path(base_path).joinpath(JOURNAL_FILENAME)
+
+
+class CampaignJournal:
+    """Append-only, fsynced event log of one run directory"""
+
+    def __init__(self, filename):
+        self.filename = pathlib.Path(filename)
+        self.fp = open(self.filename, "a+")
+        # a crash may have left a torn last line, start the next event on a fresh one
+        self.fp.seek(0, os.SEEK_END)
+        if self.fp.tell():
+            self.fp.seek(self.fp.tell() - 1)
+            if self.fp.read(1) != "\n":
+                self.fp.write("\n")
+                self.fp.flush()
+
+    def record(self, event, **fields):
+        self.fp.write(json.dumps(dict(event=event, **fields)) + "\n")
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def events(self):
+        with open(self.filename) as fp:
+            for line_nr, line in enumerate(fp, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"{self.filename}:{line_nr}: skipping torn journal entry")
+
+    def replay(self, cases=("case1", "case2", "case3", "case4")):
+        """
+        Campaign state of the journal
+
+        Returns the (case, part) pairs that were started, those whose request was sent without a recorded
+        answer (they may or may not have started) and the measurement_responses of the started ones.
+        """
+        measurement_responses = {"downloaded": [], "finished": []}
+        measurement_responses.update((case, []) for case in cases)
+        started, unconfirmed = set(), set()
+        for e in self.events():
+            if e["event"] == "starting":
+                unconfirmed.add((e["case"], e["part"]))
+            elif e["event"] == "started":
+                unconfirmed.discard((e["case"], e["part"]))
+                started.add((e["case"], e["part"]))
+                measurement_responses.setdefault(e["case"], []).extend(e["measurements"])
+            elif e["event"] == "downloaded":
+                measurement_responses[e["case"]].remove(e["id"])
+                measurement_responses["downloaded"].append(e["id"])
+            elif e["event"] == "finished":
+                measurement_responses["downloaded"].remove(e["id"])
+                measurement_responses["finished"].append(e["id"])
+            elif e["event"] == "ended":
+                measurement_responses[e["case"]].remove(e["id"])
+                measurement_responses["finished"].append(e["id"])
+        return started, unconfirmed, measurement_responses
+
+    def close(self):
+        self.fp.close()
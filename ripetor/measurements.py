@@ -1,5 +1,7 @@
+import heapq
 import json
 import logging
+from collections import deque
 from datetime import datetime
 import os
 from ipaddress import ip_address
@@ -8,6 +10,10 @@ MAX_ELEMENTS_PER_CASE = 1000
 CHUNK_SIZE = 30  # Because 100 is the limit, and some do not finish, 30 are for sure free
 COST_PER_TRACEROUTE = 20  # Because OneOff = True
 
+# Rough run time of a measurement for planning, one-to-many cases ask the probes of a single endpoint,
+# many-to-one cases wait for one probe in every AS of the set and take a lot longer
+ESTIMATED_SECONDS = {"case1": 120, "case3": 120, "case2": 600, "case4": 600}
+
 
 def template_measurement():
     return {
@@ -155,6 +161,94 @@ def calculate_number_of_measurements(definition):
     return len(definition["definitions"])
 
 
+def create_all_cases(measurement_name, measurement_sets, ip_version="ipv4"):
+    """Create the definitions of all cases the measurement sets allow (case1/4 need c_as, case2/3 need d_as)"""
+    ms = measurement_sets
+    cases = dict()
+    if ms["c_as"]:
+        cases["case1"] = create_case1(measurement_name, ms["c_as"], ms["g_as"], ip_version)
+        cases["case4"] = create_case4(measurement_name, ms["g_as_r"], ms["c_as"], ip_version)
+    if ms["d_as"]:
+        cases["case2"] = create_case2(measurement_name, ms["e_as_r"], ms["d_as"], ip_version)
+        cases["case3"] = create_case3(measurement_name, ms["d_as"], ms["e_as"], ip_version)
+    return cases
+
+
+def plan_measurements(measurement_name, measurement_sets, max_concurrent, ip_version="ipv4", credit_budget=None):
+    """
+    Pack the definitions of all cases into measurement requests that keep max_concurrent slots busy
+
+    max_concurrent is the limit of the scheduler that runs the requests, e.g. atlas.MAX_MEASUREMENTS.
+
+    Every definition takes one of the max_concurrent slots until it finishes (ESTIMATED_SECONDS). The
+    long many-to-one definitions are started first so the one-to-many ones fill the remaining slots
+    around them, and each time slots free up the next definitions of a case are packed into one request
+    of at most CHUNK_SIZE definitions, so a request that does not finish keeps only a few slots.
+    With a credit_budget, definitions are admitted round robin over the cases until it is used up.
+
+    Returns {"measurements": [{"case", "part", "definition", "start", "finish", "cost"}, ...] in start
+    order, "cost": total, "completion": predicted seconds until everything finished, "skipped": number}
+    """
+    if max_concurrent < 1:
+        raise ValueError(f"max_concurrent must be at least 1, not {max_concurrent}")
+
+    # single definitions with the probes of the request they came from
+    pending = {case: deque((definition, m["probes"]) for m in measurement_list for definition in m["definitions"])
+               for case, measurement_list in create_all_cases(measurement_name, measurement_sets, ip_version).items()}
+
+    admitted, cost, skipped = [], 0, 0
+    while any(pending.values()):
+        for case, queue in pending.items():
+            if not queue:
+                continue
+            definition, probes = queue.popleft()
+            definition_cost = COST_PER_TRACEROUTE * sum(p["requested"] for p in probes)
+            if credit_budget is not None and cost + definition_cost > credit_budget:
+                skipped += 1
+                continue
+            cost += definition_cost
+            admitted.append((case, definition, probes, definition_cost))
+    if skipped:
+        logging.warning(f"Credit budget {credit_budget} exceeded, skipping {skipped} definitions")
+
+    # longest cases first, each case in one run so its definitions can share requests
+    case_order = {case: idx for idx, case in enumerate(pending)}
+    queue = deque(sorted(admitted, key=lambda a: (-ESTIMATED_SECONDS[a[0]], case_order[a[0]])))
+
+    planned = []
+    parts = dict()
+    running = []  # heap of (finish, number of slots)
+    now, free = 0, max_concurrent
+    while queue:
+        while running and (free == 0 or running[0][0] <= now):
+            finish, slots = heapq.heappop(running)
+            now = max(now, finish)
+            free += slots
+
+        # pack the following definitions of one case (and probes) into a request as long as slots are free
+        case, _, probes, _ = queue[0]
+        measurement = template_measurement()
+        measurement["probes"] = probes
+        measurement_cost = 0
+        while queue and free and len(measurement["definitions"]) < CHUNK_SIZE and \
+                queue[0][0] == case and queue[0][2] == probes:
+            _, definition, _, definition_cost = queue.popleft()
+            measurement["definitions"].append(definition)
+            measurement_cost += definition_cost
+            free -= 1
+
+        finish = now + ESTIMATED_SECONDS[case]
+        heapq.heappush(running, (finish, len(measurement["definitions"])))
+        planned.append({"case": case, "part": parts.get(case, 0), "definition": measurement,
+                        "start": now, "finish": finish, "cost": measurement_cost})
+        parts[case] = parts.get(case, 0) + 1
+
+    return {"measurements": planned,
+            "cost": cost,
+            "completion": max((m["finish"] for m in planned), default=0),
+            "skipped": skipped}
+
+
 def main():
     # TODO ADOPT MAIN
     measurement_name = datetime.now().strftime("%Y%m%d-%H%M%S")
@@ -201,7 +295,7 @@ if __name__ == '__main__':
 def create_probes_set(probes, ip_version="ipv4"):
     probes_per_as_v4 = dict()
     probes_per_as_v6 = dict()
-    for p in probes["objects"]:
+    for p in (probes["objects"] if isinstance(probes, dict) else probes):
         if p["status_name"] == "Connected":
             as_ipv4 = f"AS{p['asn_v4']}"
             as_ipv6 = f"AS{p['asn_v6']}"
@@ -223,9 +317,10 @@ def create_exit_set(details, ip_version):
 
 
 def create_simple_set(details, filtr, ip_version="ipv4"):
+    """details is an onionoo details document or any iterable of relays, e.g. data.iter_relays"""
     relay_per_as_v4 = {}
     relay_per_as_v6 = {}
-    for r in details["relays"]:
+    for r in (details["relays"] if isinstance(details, dict) else details):
         if filtr in r["flags"]:
             if "as" in r:
                 r_addrs = r["or_addresses"]
@@ -270,4 +365,46 @@ def create_set_with_ripe_probes(details, probes, filtr, ip_version):
     for asn in as_to_delete:
         del relay_per_as[asn]
 
-    return relay_per_as
\ No newline at end of file
+    return relay_per_as
+
+
+def create_all_sets(details, probes):
+    """
+    Create g-as, e-as, g-as-r and e-as-r for ipv4 and ipv6 with a single pass over relays and probes
+
+    Returns {"ipv4": {"g_as": ..., "e_as": ..., "g_as_r": ..., "e_as_r": ...}, "ipv6": {...}} with every set
+    equal to what the create_*_set functions return for that ip_version.
+    """
+    probes_per_as = {"ipv4": {}, "ipv6": {}}
+    for p in (probes["objects"] if isinstance(probes, dict) else probes):
+        if p["status_name"] == "Connected":
+            probes_per_as["ipv4"].setdefault(f"AS{p['asn_v4']}", []).append(p["id"])
+            probes_per_as["ipv6"].setdefault(f"AS{p['asn_v6']}", []).append(p["id"])
+
+    relay_per_as = {(filtr, ip_version): {} for filtr in ("Guard", "Exit") for ip_version in ("ipv4", "ipv6")}
+    for r in (details["relays"] if isinstance(details, dict) else details):
+        filters = [filtr for filtr in ("Guard", "Exit") if filtr in r["flags"]]
+        if filters and "as" in r:
+            r_addrs = r["or_addresses"]
+            ipv4_addrs = [addr for addr in r_addrs if not "[" in addr]
+            ipv6_addrs = [addr for addr in r_addrs if "[" in addr]
+            for ip_version, addrs in (("ipv4", ipv4_addrs), ("ipv6", ipv6_addrs)):
+                if addrs:
+                    for filtr in filters:
+                        relay_per_as[filtr, ip_version].setdefault(str(r["as"]), {"relays": []})["relays"].append(
+                            {"fingerprint": r["fingerprint"], "or_addresses": addrs[0]})
+
+    sets = {}
+    for ip_version in ("ipv4", "ipv6"):
+        probes_set = probes_per_as[ip_version]
+        g_as = relay_per_as["Guard", ip_version]
+        e_as = relay_per_as["Exit", ip_version]
+        sets[ip_version] = {
+            "g_as": g_as,
+            "e_as": e_as,
+            "g_as_r": {asn: {"relays": list(o["relays"]), "ids": probes_set[asn]}
+                       for asn, o in g_as.items() if asn in probes_set},
+            "e_as_r": {asn: {"relays": list(o["relays"]), "ids": probes_set[asn]}
+                       for asn, o in e_as.items() if asn in probes_set},
+        }
+    return sets
@@ -0,0 +1,104 @@
+"""
+Append-only storage of downloaded RIPE Atlas results
+
+Every measurement gets a <case>/<id>.jsonl file with one result per line and new results are appended.
+Runs before this stored one pretty printed JSON list in <case>/<id>.json, the readers handle both.
+"""
+import json
+import pathlib
+
+SUFFIX = ".jsonl"
+LEGACY_SUFFIX = ".json"
+
+# Probes may upload their results late, so the next download starts this many seconds before the newest
+# stored result; results seen before are dropped by their (probe, timestamp). Results uploaded even later
+# are picked up by the unwindowed download before a measurement is stopped (atlas.MeasurementScheduler).
+WINDOW_OVERLAP_SECONDS = 300
+
+
+def result_filename(base_dir, case, m_id):
+    return pathlib.Path(base_dir).joinpath(case, f'{str(m_id).strip()}{SUFFIX}')
+
+
+def measurement_id(filename):
+    """Measurement id of a result file name (either format)"""
+    return pathlib.Path(filename).name.split(".")[0]
+
+
+def iter_results(filename):
+    """Yield the results stored in a .jsonl or a legacy .json result file"""
+    with open(filename) as fp:
+        if str(filename).endswith(LEGACY_SUFFIX):
+            yield from json.load(fp)
+            return
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_results(filename):
+    return list(iter_results(filename))
+
+
+def result_key(result):
+    return result.get("prb_id"), result.get("timestamp")
+
+
+class ResultLog:
+    """The result file of one measurement with the keys, probes and the newest timestamp of what it holds"""
+
+    def __init__(self, filename):
+        self.filename = pathlib.Path(filename)
+        self.keys = set()
+        self.probes = set()
+        self.last_timestamp = None
+        if self.filename.is_file():
+            self._track(iter_results(self.filename))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _track(self, results):
+        for result in results:
+            self.keys.add(result_key(result))
+            self.probes.add(result.get("prb_id"))
+            timestamp = result.get("timestamp")
+            if timestamp is not None and (self.last_timestamp is None or timestamp > self.last_timestamp):
+                self.last_timestamp = timestamp
+
+    def probe_count(self):
+        """Number of probes that delivered a result"""
+        return len(self.probes)
+
+    def window_start(self):
+        """Start of the time window (unix timestamp) to download further results from, None for everything"""
+        if self.last_timestamp is None:
+            return None
+        return self.last_timestamp - WINDOW_OVERLAP_SECONDS
+
+    def append(self, results):
+        """Append the results that are not stored yet, returns their number"""
+        new_results = []
+        for result in results:
+            key = result_key(result)
+            if key not in self.keys:
+                self.keys.add(key)
+                new_results.append(result)
+        if new_results:
+            self.filename.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.filename, "a") as fp:
+                fp.writelines(json.dumps(result) + "\n" for result in new_results)
+            self._track(new_results)
+        return len(new_results)
+
+
+# open logs by file name, so the stored keys are only read once per process
+_logs = {}
+
+
+def open_log(filename):
+    filename = pathlib.Path(filename)
+    log = _logs.get(filename)
+    if log is None:
+        log = _logs[filename] = ResultLog(filename)
+    return log
@@ -4,13 +4,15 @@ import logging
 import os
 
 try:
-    from ripetor import ip2as
+    from ripetor import ip2as, data, tables
 except:
     import ip2as
+    import data
+    import tables
 
-from datetime import datetime
 from operator import itemgetter
 import subprocess
+import numpy as np
 from collections import OrderedDict
 from ipaddress import ip_address, ip_network
 
@@ -31,6 +33,8 @@ def remove_port_from_addr_notation(addr_str):
 #allowed values for ip_version: "ipv4", "ipv6", "ipv4v6"
 #allowwed values for filter_criteria: "entry", "exit"
 def filter_relays(relays, ip_version="ipv4", filter_criteria="entry"):
+    if isinstance(relays, tables.RelayTable):
+        return relays.select(relays.ip_version_mask(ip_version))
     if "v4" in ip_version:
         relays = [r for r in relays if filter_ip_addrs(r.get("or_addresses", []), ip_version="ipv4")]
     if "v6" in ip_version:
@@ -38,40 +42,48 @@ def filter_relays(relays, ip_version="ipv4", filter_criteria="entry"):
     return relays
 
 
+def get_relay_table(details):
+    """RelayTable of an onionoo details document, an iterable of relays or an existing table"""
+    if isinstance(details, tables.RelayTable):
+        return details
+    return tables.RelayTable.from_relays(details["relays"] if isinstance(details, dict) else details)
+
+
 def get_current_relays(details):
-    max_time = max(datetime.strptime(r["last_seen"], "%Y-%m-%d %H:%M:%S") for r in details["relays"])
-    relays = [r for r in details["relays"] if datetime.strptime(r["last_seen"], "%Y-%m-%d %H:%M:%S") >= max_time]
+    """details is an onionoo details document, any iterable of relays (e.g. data.iter_relays) or a RelayTable"""
+    table = get_relay_table(details)
+    current = table.select(table.current_mask())
 
     # calculate summarized ipv6 probabilities (for normalization)
-    relays_ipv6 = filter_relays(relays, "ipv6")
-    ipv6_sum_guard_probability = sum(r.get('guard_probability', 0) for r in relays_ipv6)
-    ipv6_sum_middle_probability = sum(r.get('middle_probability', 0) for r in relays_ipv6)
-    ipv6_sum_exit_probability = sum(r.get('exit_probability', 0) for r in relays_ipv6)
+    v6 = current.has_v6
+    ipv6_sum_guard_probability = current.guard_probability[v6].sum()
+    ipv6_sum_middle_probability = current.middle_probability[v6].sum()
+    ipv6_sum_exit_probability = current.exit_probability[v6].sum()
 
     # add calculated ASN field and normalize v6 probability
-    for r in relays:
-        tor_asn = r.get("as")
-        ips_v4 = filter_ip_addrs(r.get('or_addresses', []), ip_version="ipv4")
-        ips_v6 = filter_ip_addrs(r.get('or_addresses', []), ip_version="ipv6")
-        if ips_v4:
-            ip_v4 = remove_port_from_addr_notation(ips_v4[0])
-            ip_asn_v4 = ip2as.ip2asn(ip_v4)
-            r['asn_v4_calculated'] = ip_asn_v4
-        if ips_v6:
-            ip_v6 = remove_port_from_addr_notation(ips_v6[0])
-            ip_asn_v6 = ip2as.ip2asn(ip_v6.strip("[]"))
-            r['asn_v6_calculated'] = ip_asn_v6
-            
-            # normalize ipv6 probabilities
-            r['guard_probability_v6'] = r.get('guard_probability') / ipv6_sum_guard_probability
-            r['middle_probability_v6'] = r.get('middle_probability') / ipv6_sum_middle_probability
-            r['exit_probability_v6'] = r.get('exit_probability') / ipv6_sum_exit_probability
-
-    relays_ipv4 = filter_relays(relays, "ipv4")
-    relays_ipv6 = filter_relays(relays, "ipv6")
-    relays_dualstack = filter_relays(relays, "ipv4v6")
-
-    return relays, relays_ipv4, relays_ipv6, relays_dualstack
+    relays_with_v4 = current.to_records(current.has_v4)
+    ips_v4 = [addr.rpartition(":")[0] for addr in current.or_address_v4[current.has_v4]]
+    for r, ip_asn_v4 in zip(relays_with_v4, ip2as.ip2asn_many(ips_v4)):
+        r['asn_v4_calculated'] = ip_asn_v4
+
+    relays_with_v6 = current.to_records(v6)
+    ips_v6 = [addr.rpartition(":")[0].strip("[]") for addr in current.or_address_v6[v6]]
+    guard_v6 = (current.guard_probability[v6] / ipv6_sum_guard_probability).tolist()
+    middle_v6 = (current.middle_probability[v6] / ipv6_sum_middle_probability).tolist()
+    exit_v6 = (current.exit_probability[v6] / ipv6_sum_exit_probability).tolist()
+    for r, ip_asn_v6, guard, middle, exit in zip(relays_with_v6, ip2as.ip2asn_many(ips_v6), guard_v6, middle_v6, exit_v6):
+        r['asn_v6_calculated'] = ip_asn_v6
+
+        # normalize ipv6 probabilities
+        r['guard_probability_v6'] = guard
+        r['middle_probability_v6'] = middle
+        r['exit_probability_v6'] = exit
+
+    relays_ipv4 = filter_relays(current, "ipv4").to_records()
+    relays_ipv6 = filter_relays(current, "ipv6").to_records()
+    relays_dualstack = filter_relays(current, "ipv4v6").to_records()
+
+    return current.to_records(), relays_ipv4, relays_ipv6, relays_dualstack
 
 
 def calculate_basic_tor_relay_stats(relays):
@@ -113,6 +125,8 @@ def rank_probes_per_uptime(probes):
     return probes
 
 def filter_probes(probes, ip_version="ipv4"):
+    if isinstance(probes, tables.ProbeTable):
+        return probes.select(probes.ip_version_mask(ip_version))
     if "v4" in ip_version:
         probes = [p for p in probes if p["asn_v4"]]
     if "v6" in ip_version:
@@ -120,52 +134,33 @@ def filter_probes(probes, ip_version="ipv4"):
     return probes
 
 def get_probe_ips(probe):
-    ip_v4 = probe.get("address_v4", None)
-    ip_v6 = probe.get("address_v6", None)
-    network_v4 = probe.get("prefix_v4") #prefix_v4': '84.114.0.0/15',
-    network_v6 = probe.get("prefix_v6")
-
-    # sometimes address_v4 and address_v6 are censored --> take prefix_v4': '84.114.0.0/15', 'prefix_v6': instead
-    if not ip_v4 and network_v4:
-        network = ip_network(network_v4)
-        ip_v4 = str(next(network.hosts())) # just take the first host
-
-    if not ip_v6 and network_v6:
-        network = ip_network(network_v6)
-        ip_v6 = str(next(network.hosts())) # just take the first host
+    return tables.probe_ips(probe)
 
-    return ip_v4, ip_v6
+def get_probe_table(probes):
+    """ProbeTable of a RIPE Atlas probe archive, an iterable of probes or an existing table"""
+    if isinstance(probes, tables.ProbeTable):
+        return probes
+    return tables.ProbeTable.from_probes(probes["objects"] if isinstance(probes, dict) else probes)
 
 def get_current_probes(probes):
-    connected_probes = [p for p in probes["objects"] if p["status_name"] == "Connected"]
-    connected_probes = rank_probes_per_uptime(connected_probes)
+    """probes is a RIPE Atlas probe archive, any iterable of probes (e.g. data.iter_probes) or a ProbeTable"""
+    table = get_probe_table(probes)
+    connected = table.select(table.connected_mask())
+    connected = connected.select(connected.uptime_order())
 
     # add calculated as field
-    for p in connected_probes:
-        asn_v4 = p.get('asn_v4') or 0
-        asn_v6 = p.get('asn_v6') or 0
-        asn_v4 = f"AS{asn_v4}"
-        asn_v6 = f"AS{asn_v6}"
-
-        ip_asn_v4, ip_asn_v6 = get_probe_ips(p)
-
-        if ip_asn_v4:
-            ip_asn_v4 = ip2as.ip2asn(ip_asn_v4)
-            p['asn_v4_calculated'] = ip_asn_v4
-            #if asn_v4 != ip_asn_v4:
-            #    print(f"{asn_v4} != {ip_asn_v4}")
-        if ip_asn_v6:
-            ip_asn_v6 = ip2as.ip2asn(ip_asn_v6)
-            p['asn_v6_calculated'] = ip_asn_v6
-            #if asn_v6 != ip_asn_v6:
-            #    print(f"{asn_v6} != {ip_asn_v6}")
-
-    #map(lambda x: x['asn']=x['asn_v4'], connected_probes)
-    connected_probes_v4 = filter_probes(connected_probes, "ipv4")
-    connected_probes_v6 = filter_probes(connected_probes, "ipv6")
-    connected_probes_dual_stack = filter_probes(connected_probes, "ipv4v6")
-
-    return connected_probes, connected_probes_v4, connected_probes_v6, connected_probes_dual_stack
+    for p, ip_asn_v4 in zip(connected.to_records(connected.has_v4),
+                            ip2as.ip2asn_many(connected.address_v4[connected.has_v4])):
+        p['asn_v4_calculated'] = ip_asn_v4
+    for p, ip_asn_v6 in zip(connected.to_records(connected.has_v6),
+                            ip2as.ip2asn_many(connected.address_v6[connected.has_v6])):
+        p['asn_v6_calculated'] = ip_asn_v6
+
+    connected_probes_v4 = filter_probes(connected, "ipv4").to_records()
+    connected_probes_v6 = filter_probes(connected, "ipv6").to_records()
+    connected_probes_dual_stack = filter_probes(connected, "ipv4v6").to_records()
+
+    return connected.to_records(), connected_probes_v4, connected_probes_v6, connected_probes_dual_stack
 
 def get_ordered_dict_by_value_len(unordered_dict):
     ret = OrderedDict()
@@ -221,48 +216,61 @@ def calculate_basic_ripe_stats(probes, ip_version="ipv4"):
 
     return stats
 
-def get_example_set_by_asn(probes, asn, ip_version="ipv4v6"):
-    ret_set = {"probes": [], "addresses": [], "asn":[]}
-    if isinstance(asn, str):
-        asn = int(asn.strip("AS"))
-    unfiltered, probes_v4, probes_v6, probes_ds = get_current_probes(probes)
-    if ip_version == "ipv4":
-        probes_per_as_v4, probes_per_as_v6 = get_propes_per_asn(probes_v4)
-        per_asn = probes_per_as_v4
-    elif ip_version == "ipv6":
-        probes_per_as_v4, probes_per_as_v6 = get_propes_per_asn(probes_v6)
-        per_asn = probes_per_as_v6
-    elif ip_version == "ipv4v6":
-        probes_per_as_v4, probes_per_as_v6 = get_propes_per_asn(probes_ds)
-        per_asn = probes_per_as_v4 # take v4 because more reliable?
-
-    matches = per_asn.get(asn, [])
-    if not matches:
-        print(f"no matches for AS{asn} and {ip_version}")
-    for p in matches:
-        id = p["id"]
-        asn_v4 = p.get('asn_v4') or 0
-        asn_v6 = p.get('asn_v6') or 0
-        ip_v4, ip_v6 = get_probe_ips(p)
-
-        addrs = []
-        if ip_v4:
-            addrs.append(f"{ip_v4}:0")
-        if ip_v6:
-            addrs.append(f"[{ip_v6}]:0")
-        
-        asn = asn_v4 if "v4" in ip_version else asn_v6
-
-        ret_set["probes"].append(id)
-        ret_set["addresses"].append(addrs) 
-        ret_set["asn"].append(asn)
-    
-    return ret_set
-
-
-        
+class ProbeIndex:
+    """
+    Connected probes grouped by ASN and country, built once per probe archive
+
+    connected* are the partitions of get_current_probes, per_asn[ip_version][asn] lists the probes of an AS
+    best (longest uptime) first. Dual stack probes ("ipv4v6") are grouped by their v4 ASN.
+    """
+
+    def __init__(self, probes):
+        self.connected, probes_v4, probes_v6, probes_ds = get_current_probes(probes)
+        self.connected_v4, self.connected_v6, self.connected_ds = probes_v4, probes_v6, probes_ds
+        self.per_asn = {"ipv4": get_propes_per_asn(probes_v4)[0],
+                        "ipv6": get_propes_per_asn(probes_v6)[1],
+                        "ipv4v6": get_propes_per_asn(probes_ds)[0]}
+        self.per_country = {"ipv4": get_probes_per_country_asn_ranked(probes_v4, "ipv4"),
+                            "ipv6": get_probes_per_country_asn_ranked(probes_v6, "ipv6")}
+        self.example_sets = {}
+
+    def best_probes(self, asn, ip_version="ipv4v6"):
+        """Connected probes in asn (int or "AS<number>") that can measure ip_version, best first"""
+        return self.per_asn[ip_version].get(ip2as.asn_to_int(asn), [])
+
+    def top_asns(self, country, ip_version="ipv4", n=10):
+        """ASNs of country (country code) ordered by their number of connected probes"""
+        return list(self.per_country[ip_version].get(country, {}).keys())[:n]
+
+    def example_set(self, asn, ip_version="ipv4v6"):
+        """Measurement endpoint set of the probes in asn, see get_example_set_by_asn"""
+        asn = ip2as.asn_to_int(asn)
+        key = (asn, ip_version)
+        if key not in self.example_sets:
+            ret_set = {"probes": [], "addresses": [], "asn": []}
+            for p in self.best_probes(asn, ip_version):
+                ip_v4, ip_v6 = get_probe_ips(p)
+
+                addrs = []
+                if ip_v4:
+                    addrs.append(f"{ip_v4}:0")
+                if ip_v6:
+                    addrs.append(f"[{ip_v6}]:0")
+
+                ret_set["probes"].append(p["id"])
+                ret_set["addresses"].append(addrs)
+                ret_set["asn"].append((p.get('asn_v4') if "v4" in ip_version else p.get('asn_v6')) or 0)
+            self.example_sets[key] = ret_set
+        return self.example_sets[key]
 
 
+def get_example_set_by_asn(probes, asn, ip_version="ipv4v6"):
+    """probes is anything get_current_probes accepts or, to look up many ASNs, a ProbeIndex"""
+    index = probes if isinstance(probes, ProbeIndex) else ProbeIndex(probes)
+    ret_set = index.example_set(asn, ip_version)
+    if not ret_set["probes"]:
+        print(f"no matches for AS{ip2as.asn_to_int(asn)} and {ip_version}")
+    return ret_set
 
 
 def print_basic_ripe_stats(stats, remark=""):
@@ -272,6 +280,52 @@ def print_basic_ripe_stats(stats, remark=""):
     print("in different AS:  %6d" % len(stats["probes_per_as"]))
 
 
+def calculate_as_cdf(relays, flag, asns=None):
+    """
+    Cumulative flag probability and relay count over the ASes, ordered by their flag probability
+
+    Only relays with a positive flag probability count and, if given, only the ASes in asns (numbers).
+    relays is a RelayTable or a list of relays, returns the two cumulative numpy arrays.
+    """
+    table = get_relay_table(relays)
+    probability = getattr(table, flag + "_probability")
+    mask = (probability > 0) & (table.asn >= 0)
+    asn, probability = table.asn[mask], probability[mask]
+
+    # number the ASes in order of their first relay, so equal sums keep that order when sorted
+    unique, first, inverse = np.unique(asn, return_index=True, return_inverse=True)
+    first_seen = np.argsort(first, kind="stable")
+    group = np.empty(len(unique), dtype=np.int64)
+    group[first_seen] = np.arange(len(unique))
+    group = group[inverse]
+
+    probability_sums = np.bincount(group, weights=probability, minlength=len(unique))
+    relay_counts = np.bincount(group, minlength=len(unique))
+    order = np.argsort(-probability_sums, kind="stable")
+    probability_sums, relay_counts = probability_sums[order], relay_counts[order]
+    if asns is not None:
+        with_asn = np.isin(unique[first_seen][order], np.fromiter(asns, dtype=np.int64))
+        probability_sums, relay_counts = probability_sums[with_asn], relay_counts[with_asn]
+
+    return np.cumsum(probability_sums), np.cumsum(relay_counts)
+
+
+def write_gnuplot_cdf(filename, cumulative_probability, cumulative_count):
+    with open(filename, "w+") as fp:
+        fp.write("0 0 0\n")
+        fp.write("\n".join("%d %f %d" % line for line in
+                           zip(range(1, len(cumulative_probability) + 1), cumulative_probability.tolist(),
+                               cumulative_count.tolist())))
+
+
+def write_gnuplot_as_cdfs(relays, probes_as, proto, directory="gnuplot"):
+    """Write the exit and guard .dat files of one address family, for all ASes and those with probes"""
+    table = get_relay_table(relays)
+    for flag in ("exit", "guard"):
+        write_gnuplot_cdf(f"{directory}/{flag}_{proto}_as.dat", *calculate_as_cdf(table, flag))
+        write_gnuplot_cdf(f"{directory}/{flag}_{proto}_probes_as.dat", *calculate_as_cdf(table, flag, probes_as))
+
+
 def generate_gnuplot_dat_files(relays, probes, ipv6=False):
     print("Generate gnuplot .dat Files")
     print("---------------------------")
@@ -279,37 +333,37 @@ def generate_gnuplot_dat_files(relays, probes, ipv6=False):
     # TODO Change File structure to save in other directory structure
     if not ipv6:
         logging.info(f'Creating plot data for IPv4')
-        probes_as = {"AS" + str(p["asn_v4"]) for p in probes}
+        probes_as = {p["asn_v4"] for p in probes if p["asn_v4"]}
         proto = "ipv4"
     else:
         logging.info(f'Creating plot data for IPv6')
-        probes_as = {"AS" + str(p["asn_v6"]) for p in probes}
+        probes_as = {p["asn_v6"] for p in probes if p["asn_v6"]}
         proto = "ipv6"
 
-    for flag in ("exit", "guard"):
-        filtered_relays = [r for r in relays if r[flag+"_probability"] > 0]
-        relays_per_as = dict()
-        for r in filtered_relays:
-            if "as" in r:
-                relays_per_as.setdefault(r["as"], []).append(r)
-
-        as_values = [(asn,
-                      sum([r["%s_probability" % flag] for r in relays if "%s_probability" % flag.lower() in r]),
-                      len(relays)
-                      ) for asn, relays in relays_per_as.items()]
-        as_values.sort(key=itemgetter(1), reverse=True)
-
-        with open(f"gnuplot/{flag}_{proto}_as.dat", "w+") as as_fp:
-            _, s_p, s_c = zip(*as_values)
-            summed_values = [(idx+1, sum(s_p[:idx+1]), sum(s_c[:idx+1])) for idx in range(len(s_p))]
-            as_fp.write("0 0 0\n")
-            as_fp.write("\n".join("%d %f %d" % line for line in summed_values))
-
-        with open(f"gnuplot/{flag}_{proto}_probes_as.dat", "w+") as as_probes_fp:
-            _, s_p, s_c = zip(* filter(lambda x: x[0] in probes_as, as_values))
-            summed_values = [(idx+1, sum(s_p[:idx + 1]), sum(s_c[:idx + 1])) for idx in range(len(s_p))]
-            as_probes_fp.write("0 0 0\n")
-            as_probes_fp.write("\n".join("%d %f %d" % line for line in summed_values))
+    write_gnuplot_as_cdfs(relays, probes_as, proto)
+
+
+def generate_gnuplot_dat_files_for_snapshots(details_filenames, probes, directory="gnuplot"):
+    """
+    Write the exit/guard x all/with probe x ipv4/ipv6 .dat files for many onionoo details snapshots
+
+    The files of each snapshot go to directory/<snapshot file name without extension>/. probes is
+    anything get_probe_table accepts and is only grouped once.
+    """
+    probe_table = get_probe_table(probes)
+    connected = probe_table.connected_mask()
+    probes_as_v4 = set(probe_table.asn_v4[connected & (probe_table.asn_v4 != 0)].tolist())
+    probes_as_v6 = set(probe_table.asn_v6[connected & (probe_table.asn_v6 != 0)].tolist())
+
+    for details_filename in details_filenames:
+        logging.info(f'Creating plot data for {details_filename}')
+        snapshot_directory = os.path.join(directory, os.path.splitext(os.path.basename(details_filename))[0])
+        os.makedirs(snapshot_directory, exist_ok=True)
+
+        relays = tables.RelayTable.from_relays(data.iter_relays(details_filename))
+        relays = relays.select(relays.current_mask())
+        write_gnuplot_as_cdfs(filter_relays(relays, "ipv4"), probes_as_v4, "ipv4", snapshot_directory)
+        write_gnuplot_as_cdfs(filter_relays(relays, "ipv6"), probes_as_v6, "ipv6", snapshot_directory)
 
 
 def execute_gnuplot():
@@ -342,9 +396,11 @@ def calculate_top_as_without_ripe_probe(relays, probes):
                }
               for asn, relays in relays_wo_probe_per_as.items()]
 
+    as_names = dict(zip(relays_total.keys(), ip2as.get_as_names(relays_total.keys())))
+
     top_as_total = [{"as": asn,
                 "has_probe": 1 if asn in probes_as else 0 ,
-                "as_name": ip2as.get_as_name(asn),
+                "as_name": as_names[asn],
                "nr_relays": len(relays),
                "bw_sum": sum([r["advertised_bandwidth"] for r in relays]) / 1000/1000/1000*8 ,
                "exit_sum": sum([r["exit_probability"] for r in relays if "exit_probability" in r]),
@@ -412,20 +468,20 @@ def main():
     parser.add_argument("-d", "--details", type=str, help="details .json file from onioo")
     parser.add_argument("-p", "--probes", type=str, help="probes .json file")
     parser.add_argument("-i", "--ip2asn", type=str, help="ip2asn csv file")
+    parser.add_argument("-s", "--snapshots", type=str, nargs="+",
+                        help="further details .json files to write gnuplot .dat files for (gnuplot/<name>/)")
     args = parser.parse_args()
 
     # Open Detail file
     if args.details and os.path.isfile(args.details):
-        with open(args.details, 'r') as f:
-            details = json.load(f)
+        details = data.iter_relays(args.details)
     else:
         details = None
         print("No valid details file")
 
     # Open Probes file
     if args.probes and os.path.isfile(args.probes):
-        with open(args.probes, 'r') as f:
-            probes = json.load(f)
+        probes = data.iter_probes(args.probes)
     else:
         probes = None
         print("No valid probes file")
@@ -452,7 +508,8 @@ def main():
 
     # Print Stats for Probes
     if probes:
-        unfiltered, probes_v4, probes_v6, probes_ds = get_current_probes(probes)
+        probe_index = ProbeIndex(probes)
+        probes_v4, probes_v6 = probe_index.connected_v4, probe_index.connected_v6
 
         ripe_stats = calculate_basic_ripe_stats(probes_v4, "ipv4")
         print_basic_ripe_stats(ripe_stats, "[IPv4] ")
@@ -468,6 +525,8 @@ def main():
     if details and probes:
         generate_gnuplot_dat_files(relays_v4, probes_v4)
         generate_gnuplot_dat_files(relays_v6, probes_v6, ipv6=True)
+        if args.snapshots:
+            generate_gnuplot_dat_files_for_snapshots(args.snapshots, probe_index.connected)
         # execute_gnuplot()
         print()
 
@@ -488,23 +547,20 @@ def main():
         print_country_statistic(relays_v6, probes_v6, "[IPv6] ")
         print()
 
-        ranked_v4 = get_probes_per_country_asn_ranked(probes_v4)
-        ranked_v6 = get_probes_per_country_asn_ranked(probes_v6)
-
         print("GERMANY TOP v4")
-        print(list(ranked_v4['DE'].keys())[0:10])
+        print(probe_index.top_asns('DE', "ipv4"))
         print("GERMANY TOP v6")
-        print(list(ranked_v6['DE'].keys())[0:10])
+        print(probe_index.top_asns('DE', "ipv6"))
 
         print("USA TOP v4")
-        print(list(ranked_v4['US'].keys())[0:10])
+        print(probe_index.top_asns('US', "ipv4"))
         print("USA TOP v6")
-        print(list(ranked_v6['US'].keys())[0:10])
+        print(probe_index.top_asns('US', "ipv6"))
 
         print("RUSSIA TOP v4")
-        print(list(ranked_v4['RU'].keys())[0:10])
+        print(probe_index.top_asns('RU', "ipv4"))
         print("RUSSIA TOP v6")
-        print(list(ranked_v6['RU'].keys())[0:10])
+        print(probe_index.top_asns('RU', "ipv6"))
 
 
 
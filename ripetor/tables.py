@@ -0,0 +1,231 @@
+"""
+Columnar views of onionoo relays and RIPE Atlas probes
+
+The statistics only look at a handful of fields of every relay and probe, so these are kept in numpy
+columns and filtering becomes a boolean mask instead of another pass over a list of dicts. The source
+records stay available (records column) for code that still works on the dicts.
+"""
+import socket
+from ipaddress import ip_network
+
+import numpy as np
+
+try:
+    from ripetor import ip2as
+except:
+    import ip2as
+
+# onionoo relay flags, one bit each in RelayTable.flags
+RELAY_FLAGS = ("Authority", "BadExit", "Exit", "Fast", "Guard", "HSDir", "NoEdConsensus", "Running", "Stable",
+               "StaleDesc", "Sybil", "V2Dir", "Valid")
+FLAG_BITS = {flag: 1 << bit for bit, flag in enumerate(RELAY_FLAGS)}
+
+
+def flags_to_mask(flags):
+    """Bitmask of a list of relay flags, unknown flags are ignored"""
+    mask = 0
+    for flag in flags:
+        mask |= FLAG_BITS.get(flag, 0)
+    return mask
+
+
+def _pack(ip_string, family):
+    try:
+        return socket.inet_pton(family, ip_string)
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+def _packed_column(ip_strings, version):
+    """Packed addresses, uint32 for v4 and 16 byte strings for v6, missing or invalid ones are all zero"""
+    family, size = (socket.AF_INET, 4) if version == 4 else (socket.AF_INET6, 16)
+    packed = [_pack(ip_string, family) if ip_string else None for ip_string in ip_strings]
+    packed = b"".join(p if p is not None else bytes(size) for p in packed)
+    if version == 4:
+        return np.frombuffer(packed, dtype=">u4").astype(np.uint32)
+    return np.frombuffer(packed, dtype="S16").copy()
+
+
+def _epochs(timestamps):
+    """Seconds since the epoch of onionoo "YYYY-MM-DD hh:mm:ss" timestamps"""
+    return np.array(timestamps, dtype="datetime64[s]").astype(np.int64)
+
+
+def _object_column(values):
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def probe_ips(probe):
+    """ip_v4 and ip_v6 of a probe, the first host of the announced prefix if the address is censored"""
+    ip_v4 = probe.get("address_v4", None)
+    ip_v6 = probe.get("address_v6", None)
+    network_v4 = probe.get("prefix_v4")  # prefix_v4': '84.114.0.0/15',
+    network_v6 = probe.get("prefix_v6")
+
+    # sometimes address_v4 and address_v6 are censored --> take prefix_v4': '84.114.0.0/15', 'prefix_v6': instead
+    if not ip_v4 and network_v4:
+        network = ip_network(network_v4)
+        ip_v4 = str(next(network.hosts()))  # just take the first host
+
+    if not ip_v6 and network_v6:
+        network = ip_network(network_v6)
+        ip_v6 = str(next(network.hosts()))  # just take the first host
+
+    return ip_v4, ip_v6
+
+
+class Table:
+    """Common base: a set of equally long numpy columns plus the source records"""
+
+    COLUMNS = ()
+
+    def __init__(self, records, **columns):
+        self.records = records
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        return len(self.records)
+
+    def select(self, rows):
+        """New table with the rows of a boolean mask or an index array, in that order"""
+        return type(self)(self.records[rows], **{name: getattr(self, name)[rows] for name in self.COLUMNS})
+
+    def to_records(self, rows=None):
+        """The source dicts (of the selected rows) as list"""
+        return (self.records if rows is None else self.records[rows]).tolist()
+
+
+class RelayTable(Table):
+    """
+    Relays of an onionoo details document
+
+    asn is -1 for relays without "as", or_address_v4/or_address_v6 hold the first address of each family
+    (with port, as in or_addresses) and addr_v4/addr_v6 their packed form.
+    """
+
+    COLUMNS = ("fingerprint", "asn", "flags", "or_address_v4", "or_address_v6", "has_v4", "has_v6", "addr_v4",
+               "addr_v6", "guard_probability", "middle_probability", "exit_probability", "advertised_bandwidth",
+               "last_seen")
+
+    @classmethod
+    def from_relays(cls, relays):
+        """Build the table in a single pass over an iterable of onionoo relay dicts (full or projected)"""
+        records, rows = [], []
+        for r in relays:
+            # classify the addresses once, the first of each family is the one that is measured
+            first_v4 = first_v6 = None
+            for addr in r.get("or_addresses", ()):
+                if "[" in addr:
+                    first_v6 = first_v6 or addr
+                else:
+                    first_v4 = first_v4 or addr
+            asn = r.get("as")
+            records.append(r)
+            rows.append((r.get("fingerprint", ""), ip2as.asn_to_int(asn) if asn else -1,
+                         flags_to_mask(r.get("flags", ())), first_v4, first_v6,
+                         first_v4 and first_v4.rpartition(":")[0],
+                         first_v6 and first_v6.rpartition(":")[0].strip("[]"),
+                         r.get("guard_probability", 0), r.get("middle_probability", 0), r.get("exit_probability", 0),
+                         r.get("advertised_bandwidth", 0), r["last_seen"]))
+
+        (fingerprints, asns, flags, or_addresses_v4, or_addresses_v6, ips_v4, ips_v6, guard_probabilities,
+         middle_probabilities, exit_probabilities, bandwidths, last_seen) = zip(*rows) if rows else [()] * 12
+
+        or_address_v4 = _object_column(or_addresses_v4)
+        or_address_v6 = _object_column(or_addresses_v6)
+        return cls(
+            _object_column(records),
+            fingerprint=np.array(fingerprints, dtype="U40"),
+            asn=np.array(asns, dtype=np.int64),
+            flags=np.array(flags, dtype=np.uint32),
+            or_address_v4=or_address_v4,
+            or_address_v6=or_address_v6,
+            # an address counts even if it can not be packed, as filter_ip_addrs only looks at the notation
+            has_v4=np.not_equal(or_address_v4, None).astype(bool),
+            has_v6=np.not_equal(or_address_v6, None).astype(bool),
+            addr_v4=_packed_column(ips_v4, 4),
+            addr_v6=_packed_column(ips_v6, 6),
+            guard_probability=np.array(guard_probabilities, dtype=np.float64),
+            middle_probability=np.array(middle_probabilities, dtype=np.float64),
+            exit_probability=np.array(exit_probabilities, dtype=np.float64),
+            advertised_bandwidth=np.array(bandwidths, dtype=np.int64),
+            last_seen=_epochs(last_seen),
+        )
+
+    def flag_mask(self, flag):
+        return (self.flags & FLAG_BITS[flag]) != 0
+
+    def ip_version_mask(self, ip_version="ipv4"):
+        """Relays reachable by ip_version ("ipv4", "ipv6" or "ipv4v6" for dual stack)"""
+        mask = np.ones(len(self), dtype=bool)
+        if "v4" in ip_version:
+            mask &= self.has_v4
+        if "v6" in ip_version:
+            mask &= self.has_v6
+        return mask
+
+    def current_mask(self):
+        """Relays seen in the latest consensus"""
+        if not len(self):
+            return np.zeros(0, dtype=bool)
+        return self.last_seen >= self.last_seen.max()
+
+
+class ProbeTable(Table):
+    """
+    Probes of a RIPE Atlas probe archive
+
+    asn_v4/asn_v6 are 0 for probes without ASN, address_v4/address_v6 fall back to the announced prefix
+    (see probe_ips) and addr_v4/addr_v6 are their packed form.
+    """
+
+    COLUMNS = ("id", "asn_v4", "asn_v6", "country", "status", "total_uptime", "address_v4", "address_v6",
+               "has_v4", "has_v6", "addr_v4", "addr_v6")
+
+    @classmethod
+    def from_probes(cls, probes):
+        """Build the table in a single pass over an iterable of RIPE Atlas probe dicts (full or projected)"""
+        records, rows = [], []
+        for p in probes:
+            ip_v4, ip_v6 = probe_ips(p)
+            records.append(p)
+            rows.append((p["id"], p.get("asn_v4") or 0, p.get("asn_v6") or 0, p.get("country_code"),
+                         p.get("status_name"), p.get("total_uptime") or 0, ip_v4, ip_v6))
+
+        ids, asns_v4, asns_v6, countries, statuses, uptimes, addresses_v4, addresses_v6 = \
+            zip(*rows) if rows else [()] * 8
+
+        return cls(
+            _object_column(records),
+            id=np.array(ids, dtype=np.int64),
+            asn_v4=np.array(asns_v4, dtype=np.int64),
+            asn_v6=np.array(asns_v6, dtype=np.int64),
+            country=_object_column(countries),
+            status=_object_column(statuses),
+            total_uptime=np.array(uptimes, dtype=np.int64),
+            address_v4=_object_column(addresses_v4),
+            address_v6=_object_column(addresses_v6),
+            has_v4=np.array([bool(a) for a in addresses_v4], dtype=bool),
+            has_v6=np.array([bool(a) for a in addresses_v6], dtype=bool),
+            addr_v4=_packed_column(addresses_v4, 4),
+            addr_v6=_packed_column(addresses_v6, 6),
+        )
+
+    def connected_mask(self):
+        return self.status == "Connected"
+
+    def ip_version_mask(self, ip_version="ipv4"):
+        """Probes with an ASN for ip_version ("ipv4", "ipv6" or "ipv4v6" for dual stack)"""
+        mask = np.ones(len(self), dtype=bool)
+        if "v4" in ip_version:
+            mask &= self.asn_v4 != 0
+        if "v6" in ip_version:
+            mask &= self.asn_v6 != 0
+        return mask
+
+    def uptime_order(self):
+        """Row order by total uptime, longest first (ties keep their order like rank_probes_per_uptime)"""
+        return np.argsort(-self.total_uptime, kind="stable")
@@ -0,0 +1,34 @@
+"""
+Structured trace of per item diagnostics as JSON lines
+
+Tracing is off until open_trace is called. Callers check enabled() before they compute anything for a
+record, so diagnostics cost nothing while it is off:
+
+    if tracing.enabled():
+        tracing.record("route", case=case, asns=[...])
+"""
+import json
+
+_trace_file = None
+
+
+def open_trace(filename):
+    """Start writing records to filename (replacing it)"""
+    global _trace_file
+    close_trace()
+    _trace_file = open(filename, "w")
+
+
+def close_trace():
+    global _trace_file
+    if _trace_file is not None:
+        _trace_file.close()
+        _trace_file = None
+
+
+def enabled():
+    return _trace_file is not None
+
+
+def record(kind, **fields):
+    _trace_file.write(json.dumps(dict(kind=kind, **fields), separators=(",", ":")) + "\n")
@@ -39,14 +39,14 @@ def get_file_logger(name, log_file):
     return logger
 
 
-def set_global_file_logger(log_file, debug=False):
+def set_global_file_logger(log_file, debug=False, append=False):
     log_format = get_default_format()
 
     logging.basicConfig(
         level=logging.DEBUG,
         format=log_format,
         filename=log_file,
-        filemode="w"
+        filemode="a" if append else "w"
     )
 
     console = logging.StreamHandler()
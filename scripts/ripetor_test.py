@@ -71,13 +71,13 @@ class RIPETorTest:
         running_ids = len(responses['running'])
         while running_ids > 0:
 
-            for measurement_id in responses['running']:
-                response = atlas.get_measurement_status(measurement_id, update=True)
-                if response is None:
+            statuses = atlas.get_measurement_statuses(responses['running'], update=True)
+            for measurement_id in list(responses['running']):
+                if int(measurement_id) not in statuses:
                     self.__log.warning(f'Could not get status for measurement_id {measurement_id}')
                     continue
 
-                measurement_status = int(response['status']['id'])
+                measurement_status = int(statuses[int(measurement_id)])
                 self.__log.debug(f'Status for {measurement_id} is {measurement_status}')
 
                 if measurement_status < 4:
@@ -1,8 +1,13 @@
 import argparse
 import ip2asn
 import json
+import sys
 from pathlib import Path
 
+# the repository root, so the script also runs directly (python scripts/split_measurement.py)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from ripetor import results
+
 
 def get_asn_sets():
     tranco_set_historic = {'AS3', 'AS15169', 'AS4837', 'AS24940', 'AS36351', 'AS14618', 'AS16509', 'AS14907', 'AS3356',
@@ -22,24 +27,22 @@ def get_asn_sets():
 
 def read_results(case_path: Path, ip2asn: ip2asn.IP2ASN):
     response_dict = {}
-    for measurement_path in case_path.glob("*.json"):
-        with open(measurement_path) as measurement_file:
-            json_file = json.load(measurement_file)
-
-            dst_addresses = set()
-            msm_ids = set()
-            for measurement in json_file:
-                dst_addresses.add(measurement['dst_addr'])
-                msm_ids.add(measurement['msm_id'])
-
-            if len(dst_addresses) != 1:
-                print(f'Found {len(dst_addresses)} instead of 1 in file {measurement_path}')
-                continue
-
-            dst_address = dst_addresses.pop()
-            msm_id = msm_ids.pop()
-            asn = ip2asn.lookup_address(dst_address)
-            response_dict[msm_id] = asn['ASN']
+    measurement_paths = list(case_path.glob("*" + results.SUFFIX)) + list(case_path.glob("*" + results.LEGACY_SUFFIX))
+    for measurement_path in measurement_paths:
+        dst_addresses = set()
+        msm_ids = set()
+        for measurement in results.iter_results(measurement_path):
+            dst_addresses.add(measurement['dst_addr'])
+            msm_ids.add(measurement['msm_id'])
+
+        if len(dst_addresses) != 1:
+            print(f'Found {len(dst_addresses)} instead of 1 in file {measurement_path}')
+            continue
+
+        dst_address = dst_addresses.pop()
+        msm_id = msm_ids.pop()
+        asn = ip2asn.lookup_address(dst_address)
+        response_dict[msm_id] = asn['ASN']
     return response_dict
 
 def main():
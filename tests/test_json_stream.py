@@ -0,0 +1,37 @@
+import io
+import json
+import unittest
+
+from ripetor import data
+
+DOCUMENT = '{"version": 1.25e3, "relays": [1, 1.5, -2.25e-3, 10E+2, 0, true, null, "x", {"as": 1.5}, 123456789]}'
+
+
+class SplitReader(io.StringIO):
+    """File object that returns the text up to offset on the first read and the rest afterwards"""
+
+    def __init__(self, text, offset):
+        super().__init__(text)
+        self.offset = offset
+
+    def read(self, size=-1):
+        if self.offset:
+            size, self.offset = self.offset, 0
+        return super().read(size)
+
+
+class JsonStreamTest(unittest.TestCase):
+
+    def test_every_split_offset(self):
+        expected = json.loads(DOCUMENT)["relays"]
+        for offset in range(1, len(DOCUMENT)):
+            with self.subTest(offset=offset):
+                self.assertEqual(list(data.read_json_array(SplitReader(DOCUMENT, offset), "relays")), expected)
+
+    def test_number_at_end_of_document(self):
+        stream = data.JsonStream(SplitReader("12.5e1", 3))
+        self.assertEqual(stream.value(), 125.0)
+
+
+if __name__ == "__main__":
+    unittest.main()